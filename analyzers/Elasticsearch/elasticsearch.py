@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 
+import hashlib
+import ipaddress
+import json
+import os
 import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 from cortexutils.analyzer import Analyzer
@@ -41,10 +49,290 @@ WINDOWS_UNSUCCESSFUL_LOGON_CODES = {
 }
 CISCO_VPN_MESSAGE_ID = "722051"
 MAX_RESULT_SIZE = 100
+AGGREGATION_PAGE_SIZE = 1000
+STREAM_PAGE_SIZE = 1000
+DEFAULT_MAX_ROWS = 50000
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+PIT_KEEP_ALIVE = "1m"
+MSEARCH_BATCH_SIZE = 50
+BATCH_SEPARATORS = re.compile(r"[\n,]")
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_SLICES = 1
+DEFAULT_WORKERS = 4
+DEFAULT_STATE_TTL = 24 * 60 * 60
+MAX_SUMMARY_GROUPS = 1000
+MODES = ("hits", "aggregate", "stream", "summary")
+WINDOWS_SERVICES = ("windows-user-login-ips", "windows-user-ip-logins")
+# service: (observable field, returned field, result noun)
+SERVICE_FIELDS = {
+    "windows-user-login-ips": ("user.name", "source.ip", "ips"),
+    "cisco-vpn-user-login-ips": ("user.name", "source.ip", "ips"),
+    "cisco-vpn-ip-login-users": ("source.ip", "user.name", "users"),
+    "windows-user-ip-logins": ("source.ip", "user.name", "users"),
+}
 DEFAULT_HOURS = 12
 SAFE_IP_COUNT = 2
 SAFE_USER_COUNT = 2
 IGNORE_IPS_SAFE_CHARS = re.compile(r"^[0-9/\.\:,\s]+$")
+# "now" is rounded so range filters stay the same for a while and can be cached
+DATE_ROUNDING = "m"
+WINDOWS_SOURCE_FIELDS = [
+    "source.ip",
+    "agent.hostname",
+    "winlog.event_data.LogonType",
+    "@timestamp",
+    "event.code",
+    "winlog.event_data.SubStatus",
+    "user.name",
+]
+CISCO_SOURCE_FIELDS = ["user.name", "source.ip", "@timestamp"]
+# slim responses, only docvalue fields plus what paging and incremental runs need
+SLIM_FILTER_PATH = "pit_id,hits.hits._id,hits.hits.fields,hits.hits.sort"
+SLIM_MSEARCH_FILTER_PATH = "responses.status,responses.error,responses.hits.hits.fields"
+
+
+def extract_fields(hit, fields):
+    """Extract Fields
+    Flatten a hit to {dotted field name: value} for the given fields.  Reads the
+    docvalue "fields" of slim responses or walks the nested "_source", missing
+    fields are left out.
+    """
+    if "fields" in hit:
+        return {
+            field: hit["fields"][field][0] for field in fields if field in hit["fields"]
+        }
+
+    flat = dict()
+    for field in fields:
+        value = hit["_source"]
+        for part in field.split("."):
+            if not isinstance(value, dict) or part not in value:
+                value = None
+                break
+            value = value[part]
+        if value is not None:
+            flat[field] = value
+    return flat
+
+
+def compile_query(service, observable, hours, ignore_ips=(), time_range=None):
+    """Compile Query
+    Build the bool query for a service.  Every clause is a non-scoring filter
+    (term/terms/exists/range) so Elasticsearch can skip scoring and cache them.
+    ignore_ips must already be validated, plain addresses become a single terms
+    clause and each CIDR a term clause, which the ip field type runs as a range.
+    time_range is an optional (gte, lt) pair of epoch milliseconds used instead
+    of the last hours, lt may be None for an open ended range.
+    """
+    observable_field, key_field = SERVICE_FIELDS[service][:2]
+
+    filters = [
+        {"exists": {"field": "source.ip"}},
+        {"exists": {"field": "user.name"}},
+    ]
+    if service in WINDOWS_SERVICES:
+        filters.append({"exists": {"field": "agent.hostname"}})
+    filters.append({"term": {observable_field: observable}})
+
+    if service in WINDOWS_SERVICES:
+        filters.append(
+            {
+                "terms": {
+                    "event.code": [
+                        WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE,
+                        WINDOWS_UNSUCCESSFUL_LOGON_EVENT_CODE,
+                    ]
+                }
+            }
+        )
+    else:
+        filters.append({"term": {"cisco.asa.message_id": CISCO_VPN_MESSAGE_ID}})
+
+    if time_range is None:
+        filters.append(
+            {"range": {"@timestamp": {"gte": f"now-{hours}h/{DATE_ROUNDING}"}}}
+        )
+    else:
+        timestamp_range = {"gte": time_range[0], "format": "epoch_millis"}
+        if time_range[1] is not None:
+            timestamp_range["lt"] = time_range[1]
+        filters.append({"range": {"@timestamp": timestamp_range}})
+
+    query = {"bool": {"filter": filters}}
+
+    if key_field == "source.ip" and ignore_ips:
+        addresses = [ip for ip in ignore_ips if "/" not in ip]
+        networks = [ip for ip in ignore_ips if "/" in ip]
+
+        must_not = list()
+        if addresses:
+            must_not.append({"terms": {"source.ip": addresses}})
+        for network in networks:
+            must_not.append({"term": {"source.ip": network}})
+        query["bool"]["must_not"] = must_not
+
+    return query
+
+
+class ResultCache:
+    """Result Cache
+    SQLite backed cache of analyzer results shared by every run on the host.  Keys
+    include a time bucket of ttl seconds, entries older than ttl are never returned
+    and the oldest entries are evicted once stored results exceed max_bytes.
+    """
+
+    def __init__(self, path, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, created REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS counters "
+                "(name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    def key(self, *parts):
+        bucket = int(time.time() // self.ttl)
+        return hashlib.sha256(
+            json.dumps([bucket] + list(parts), sort_keys=True).encode()
+        ).hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM results WHERE key = ? AND created >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            self._count("misses")
+            return None
+
+        self.hits += 1
+        self._count("hits")
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results (key, created, value) VALUES (?, ?, ?)",
+                (key, time.time(), json.dumps(value)),
+            )
+            self.connection.execute(
+                "DELETE FROM results WHERE created < ?", (time.time() - self.ttl,)
+            )
+            self.connection.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM "
+                "(SELECT key, SUM(LENGTH(value)) OVER (ORDER BY created DESC) AS size "
+                "FROM results) WHERE size > ?)",
+                (self.max_bytes,),
+            )
+
+    def stats(self):
+        stats = {"hits": self.hits, "misses": self.misses}
+        for name, value in self.connection.execute("SELECT name, value FROM counters"):
+            stats["total_" + name] = value
+        return stats
+
+    def _count(self, name):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
+
+
+class StreamBudget:
+    """Stream Budget
+    Row and byte caps of a stream search, shared by its slices.  Rows are
+    reserved before each page is requested so slices running at the same time
+    never return more than max_rows together, bytes are counted after each page.
+    """
+
+    def __init__(self, max_rows, max_bytes):
+        self.rows = max_rows
+        self.bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def reserve(self, rows):
+        with self.lock:
+            if self.bytes <= 0:
+                return 0
+            rows = min(rows, self.rows)
+            self.rows -= rows
+            return rows
+
+    def release(self, rows, size):
+        with self.lock:
+            self.rows += rows
+            self.bytes -= size
+
+
+class WatermarkStore:
+    """Watermark Store
+    SQLite backed store of the newest @timestamp (epoch milliseconds) seen per
+    key plus the state accumulated up to it.  Entries not updated for ttl
+    seconds are expired on read.
+    """
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks (key TEXT PRIMARY KEY, "
+                "watermark INTEGER NOT NULL, updated REAL NOT NULL, state TEXT NOT NULL)"
+            )
+
+    def key(self, *parts):
+        return hashlib.sha256(
+            json.dumps(list(parts), sort_keys=True).encode()
+        ).hexdigest()
+
+    def get(self, key):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM watermarks WHERE updated < ?", (time.time() - self.ttl,)
+            )
+        row = self.connection.execute(
+            "SELECT watermark, state FROM watermarks WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def put(self, key, watermark, state):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO watermarks (key, watermark, updated, state) "
+                "VALUES (?, ?, ?, ?)",
+                (key, watermark, time.time(), json.dumps(state)),
+            )
+
+    def delete(self, key):
+        with self.connection:
+            self.connection.execute("DELETE FROM watermarks WHERE key = ?", (key,))
 
 
 class Elasticsearch(Analyzer):
@@ -63,6 +351,14 @@ class Elasticsearch(Analyzer):
         self.hours = self.get_param("config.es_hours", DEFAULT_HOURS)
         self.user_agent = self.get_param("config.user_agent", USER_AGENT)
         self.service = self.get_param("config.service", None, "Service is missing")
+        self.mode = self.get_param("config.es_mode", "hits")
+        self.max_rows = self.get_param("config.es_max_rows", DEFAULT_MAX_ROWS)
+        self.max_bytes = self.get_param("config.es_max_bytes", DEFAULT_MAX_BYTES)
+        self.slices = self.get_param("config.es_slices", DEFAULT_SLICES)
+        self.workers = self.get_param("config.es_workers", DEFAULT_WORKERS)
+        self.result_budget = self.get_param("config.es_result_budget", None)
+        self.slim = self.get_param("config.es_slim", False)
+        self.batch = self.get_param("config.es_batch", False)
 
         self.data = self.get_data()
 
@@ -76,18 +372,63 @@ class Elasticsearch(Analyzer):
             self.error("Hours must be greater than 0.")
 
         ignore_ips = self.get_param("config.es_ignore_ips", None)
-        if ignore_ips is None:
-            self.ignore_ips = []
-        else:
-            self.ignore_ips = [x.strip() for x in ignore_ips.split(",")]
+        self.ignore_ips = []
+        if ignore_ips is not None:
+            for ip in ignore_ips.split(","):
+                ip = ip.strip()
+                if IGNORE_IPS_SAFE_CHARS.match(ip) is None:
+                    self.error(f"Ignore IP does not match safe characters: {ip}")
+                try:
+                    ipaddress.ip_network(ip, strict=False)
+                except ValueError:
+                    self.error(f"Ignore IP is not an IP address or CIDR: {ip}")
+                self.ignore_ips.append(ip)
 
         if self.service not in SERVICES:
             self.error("bad service")
 
+        if self.mode not in MODES:
+            self.error("bad mode")
+
+        if self.max_rows < 1 or self.max_bytes < 1:
+            self.error("Max rows and max bytes must be greater than 0.")
+
+        if self.slices < 1 or self.workers < 1:
+            self.error("Slices and workers must be greater than 0.")
+
         self.verify = self.get_param("config.ca_cert_path", True)
 
         self.proxies = self.get_param("config.proxy", None)
 
+        # result cache is only used when a path is configured
+        self.cache = None
+        self.cache_bypass = self.get_param("config.cache_bypass", False)
+        cache_path = self.get_param("config.cache_path", None)
+        if cache_path is not None:
+            cache_ttl = self.get_param("config.cache_ttl", DEFAULT_CACHE_TTL)
+            if cache_ttl < 1:
+                self.error("Cache TTL must be greater than 0.")
+            self.cache = ResultCache(
+                cache_path,
+                cache_ttl,
+                self.get_param("config.cache_max_bytes", DEFAULT_CACHE_MAX_BYTES),
+            )
+
+        # incremental runs keep watermarks in a local state store
+        self.state = None
+        # a job parameter, so an analyst resets one observable rather than all
+        self.state_reset = self.get_param("parameters.es_state_reset", False)
+        if self.get_param("config.es_incremental", False):
+            if self.mode not in ("hits", "stream") or self.slices > 1:
+                self.error("Incremental runs need hits or stream mode without slices.")
+            state_ttl = self.get_param("config.es_state_ttl", DEFAULT_STATE_TTL)
+            if state_ttl < 1:
+                self.error("State TTL must be greater than 0.")
+            self.state = WatermarkStore(
+                self.get_param("config.es_state_path", None, "Missing ES state path"),
+                state_ttl,
+            )
+
     def artifacts(self, raw):
         if self.service in ("cisco-vpn-ip-login-users", "windows-user-ip-logins"):
             users = raw.get("successful_logon_users", []) + raw.get(
@@ -128,294 +469,720 @@ class Elasticsearch(Analyzer):
         return {"taxonomies": [self.build_taxonomy(level, "ES", predicate, count)]}
 
     def run(self):
-        results = dict()
-        must_not = self._build_ignore_ips()
-
-        if self.service == "windows-user-ip-logins":
-            data = {
-                "_source": [
-                    "source.ip",
-                    "agent.hostname",
-                    "winlog.event_data.LogonType",
-                    "@timestamp",
-                    "event.code",
-                    "winlog.event_data.SubStatus",
-                    "user.name",
-                ],
-                "sort": [{"@timestamp": {"order": "desc"}}],
-                "size": MAX_RESULT_SIZE,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"exists": {"field": "source.ip"}},
-                            {"exists": {"field": "user.name"}},
-                            {"exists": {"field": "agent.hostname"}},
-                            {"match": {"source.ip": self.data}},
-                        ],
-                        "should": [
-                            {
-                                "match": {
-                                    "event.code": WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE
-                                }
-                            },
-                            {
-                                "match": {
-                                    "event.code": WINDOWS_UNSUCCESSFUL_LOGON_EVENT_CODE
-                                }
-                            },
-                        ],
-                        "minimum_should_match": 1,
-                        "filter": {
-                            "range": {"@timestamp": {"gte": f"now-{self.hours}h"}}
-                        },
-                    }
-                },
-            }
-
-            json_data = self._get_response(data)
-
-            results["successful_logon_users"] = set()
-            results["unsuccessful_logon_users"] = set()
-            results["logon_info"] = list()
+        # only split when asked, user names such as "CN=...,OU=..." hold commas
+        observables = [self.data]
+        if self.batch:
+            observables = [x.strip() for x in BATCH_SEPARATORS.split(self.data)]
+            observables = [x for x in observables if x]
+
+        if len(observables) > 1:
+            results = self._merge_results(self.batch_lookup(observables))
+        else:
+            results = self._lookup(self.data)
 
-            for hit in json_data["hits"]["hits"]:
-                user = hit["_source"]["user"]["name"]
-                event_code = hit["_source"]["event"]["code"]
+        if self.cache is not None:
+            results["cache"] = self.cache.stats()
 
-                item = {
-                    "host": hit["_source"]["agent"]["hostname"],
-                    "timestamp": hit["_source"]["@timestamp"],
-                    "user": user,
-                    "event_code": event_code,
-                }
+        self.report(results)
 
-                if event_code == WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE:
-                    results["successful_logon_users"].add(user)
-                    item["outcome"] = "success"
+    def batch_lookup(self, observables):
+        """Batch Lookup
+        Run the service for many observables.  In "hits" mode (unsliced) the query
+        bodies are sent together with one _msearch request per MSEARCH_BATCH_SIZE
+        observables.  Returns a dict of observable to the results run reports for it alone, an
+        observable whose search failed gets {"error": reason} instead.
+        """
+        if self.mode != "hits" or self.slices > 1 or self.state is not None:
+            return {observable: self._lookup(observable) for observable in observables}
+
+        reports = dict()
+        missing = list()
+        for observable in observables:
+            results = self._cache_get(observable)
+            if results is None:
+                missing.append(observable)
+            else:
+                reports[observable] = results
+
+        for i in range(0, len(missing), MSEARCH_BATCH_SIZE):
+            batch = missing[i : i + MSEARCH_BATCH_SIZE]
+
+            lines = list()
+            for observable in batch:
+                lines.append(json.dumps({"index": self.index}))
+                lines.append(json.dumps(self._build_search_body(observable)))
+
+            headers = dict(self.headers)
+            headers["Content-Type"] = "application/x-ndjson"
+            params = None
+            if self.slim:
+                params = {"filter_path": SLIM_MSEARCH_FILTER_PATH}
+            response = self._request(
+                "post",
+                "/_msearch",
+                data="\n".join(lines) + "\n",
+                headers=headers,
+                params=params,
+            )
 
+            for observable, json_data in zip(batch, response.json()["responses"]):
+                if "error" in json_data:
+                    error = json_data["error"]
+                    if isinstance(error, dict):
+                        error = error.get("reason", error.get("type"))
+                    reports[observable] = {"error": error}
                 else:
-                    results["unsuccessful_logon_users"].add(user)
-                    item["outcome"] = "failure"
-
-                if "LogonType" in hit["_source"]["winlog"]["event_data"]:
-                    logon_type = hit["_source"]["winlog"]["event_data"]["LogonType"]
-                    item["logon_type"] = logon_type
-                    item["verbose_logon_type"] = WINDOWS_SUCCESSFUL_LOGON_TYPES.get(
-                        logon_type, "unknown"
-                    )
-                if "SubStatus" in hit["_source"]["winlog"]["event_data"]:
-                    substatus = hit["_source"]["winlog"]["event_data"]["SubStatus"]
-                    item["substatus"] = substatus
-                    item["verbose_substatus"] = WINDOWS_UNSUCCESSFUL_LOGON_CODES.get(
-                        substatus, "unknown"
+                    reports[observable] = self._parse_hits(
+                        json_data.get("hits", {}).get("hits", [])
                     )
+                    self._cache_put(observable, reports[observable])
+
+        return reports
+
+    def _merge_results(self, reports):
+        noun = SERVICE_FIELDS[self.service][2]
+        results = {"observables": reports}
+
+        total = 0
+        for outcome in ("successful", "unsuccessful"):
+            key = f"{outcome}_logon_{noun}"
+            values = set()
+            found = False
+            for report in reports.values():
+                if key in report:
+                    found = True
+                    values.update(report[key])
+            if found:
+                results[key] = sorted(values)
+                total += len(values)
+        results[f"total_{noun}"] = total
+
+        return results
+
+    def _lookup(self, observable):
+        if self.state is not None:
+            return self._search_incremental(observable)
+
+        results = self._cache_get(observable)
+        if results is None:
+            results = self._search(observable)
+            self._cache_put(observable, results)
+
+        return results
+
+    def _cache_key(self, observable):
+        return self.cache.key(
+            self.url,
+            self.index,
+            self.service,
+            self.mode,
+            observable,
+            self.hours,
+            self.ignore_ips,
+            self.max_rows,
+            self.max_bytes,
+            self.slices,
+            self.result_budget,
+            self.slim,
+        )
 
-                results["logon_info"].append(item)
+    def _cache_get(self, observable):
+        if self.cache is None or self.cache_bypass:
+            return None
+        return self.cache.get(self._cache_key(observable))
+
+    def _cache_put(self, observable, results):
+        if self.cache is not None:
+            self.cache.put(self._cache_key(observable), results)
+
+    def _search(self, observable, time_range=None, budget=None):
+        if self.slices > 1 and time_range is None:
+            return self._search_slices(observable)
+
+        data = self._build_search_body(observable, time_range)
+
+        if self.mode == "aggregate":
+            results = self._aggregate(data["query"])
+        elif self.mode == "summary":
+            # slices keep every group, the merge bounds the summary once
+            results = self._summarize(data["query"], bound=time_range is None)
+        elif self.mode == "stream":
+            stats = dict()
+            results = self._parse_hits(self._stream_hits(data, stats, budget))
+            results["stream"] = stats
+        else:
+            json_data = self._get_response(data, slim=self.slim)
+            results = self._parse_hits(json_data.get("hits", {}).get("hits", []))
+
+        return results
+
+    def _search_incremental(self, observable):
+        """Search Incremental
+        Only search events newer than the stored watermark for this observable and
+        merge them into the unique users/IPs accumulated by earlier runs.  Events
+        are read oldest first so a capped run never skips past unread events, the
+        next run carries on from where it stopped.  Searches start at the
+        watermark itself and exclude the event IDs already read at that
+        @timestamp, so events sharing it with the last event of a capped run are
+        not lost.
+        logon_info holds only the new events.
+        """
+        noun = SERVICE_FIELDS[self.service][2]
+        key = self.state.key(
+            self.url, self.index, self.service, observable, self.ignore_ips
+        )
+        if self.state_reset:
+            self.state.delete(key)
+
+        previous, accumulated = self.state.get(key)
+        accumulated = accumulated or dict()
+        read_ids = set(accumulated.pop("watermark_ids", []))
+        time_range = None
+        if previous is not None:
+            time_range = (previous, None)
+
+        data = self._build_search_body(observable, time_range)
+        data["sort"] = [{"@timestamp": {"order": "asc"}}]
+        if read_ids:
+            data["query"]["bool"].setdefault("must_not", []).append(
+                {"ids": {"values": sorted(read_ids)}}
+            )
+        latest = [previous]
+        latest_ids = set(read_ids)
+
+        def track(hits):
+            for hit in hits:
+                if "sort" not in hit:
+                    yield hit
+                    continue
+
+                timestamp = hit["sort"][0]
+                if latest[0] is None or timestamp > latest[0]:
+                    latest[0] = timestamp
+                    latest_ids.clear()
+                latest_ids.add(hit.get("_id"))
+                yield hit
+
+        if self.mode == "stream":
+            stats = dict()
+            results = self._parse_hits(track(self._stream_hits(data, stats)))
+            results["stream"] = stats
+            caught_up = not stats["truncated"]
+        else:
+            json_data = self._get_response(data, slim=self.slim)
+            hits = json_data.get("hits", {}).get("hits", [])
+            results = self._parse_hits(track(hits))
+            caught_up = len(hits) < MAX_RESULT_SIZE
+
+        total = 0
+        for outcome in ("successful", "unsuccessful"):
+            result_key = f"{outcome}_logon_{noun}"
+            if result_key in results:
+                accumulated[result_key] = sorted(
+                    set(accumulated.get(result_key, [])).union(results[result_key])
+                )
+                results[result_key] = accumulated[result_key]
+                total += len(results[result_key])
+        results[f"total_{noun}"] = total
+
+        if latest[0] is not None:
+            state = dict(accumulated)
+            state["watermark_ids"] = sorted(x for x in latest_ids if x is not None)
+            self.state.put(key, latest[0], state)
+
+        results["incremental"] = {
+            "previous_watermark": previous,
+            "watermark": latest[0],
+            "new_events": len(results["logon_info"]),
+            "caught_up": caught_up,
+        }
 
-            results["successful_logon_users"] = list(results["successful_logon_users"])
-            results["unsuccessful_logon_users"] = list(
-                results["unsuccessful_logon_users"]
+        return results
+
+    def _search_slices(self, observable):
+        """Search Slices
+        Split the last hours into equal @timestamp slices, newest first, and search
+        them concurrently with up to es_workers threads.  The newest slice is open
+        ended so events after the minute rounded "now" are still searched.  Once
+        es_result_budget rows (unique keys in aggregate mode) have come back,
+        slices that have not started are skipped, running slices still finish so
+        the budget only applies when es_slices is larger than es_workers.  Slice
+        results are merged in slice order so the newest first timeline ordering
+        holds.
+        """
+        now = int(time.time() // 60 * 60 * 1000)
+        width = self.hours * 3600 * 1000 / self.slices
+        time_ranges = [
+            (int(now - width * (i + 1)), int(now - width * i) if i else None)
+            for i in range(self.slices)
+        ]
+
+        slice_results = [None] * self.slices
+        slice_stats = [
+            {"gte": gte, "lt": lt, "status": "skipped"} for gte, lt in time_ranges
+        ]
+        budget_reached = False
+        size = 0
+        # stream caps hold for the merged result, not each slice
+        stream_budget = StreamBudget(self.max_rows, self.max_bytes)
+
+        def search_slice(index):
+            start = time.perf_counter()
+            results = self._search(observable, time_ranges[index], stream_budget)
+            return index, results, (time.perf_counter() - start) * 1000
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(search_slice, i) for i in range(self.slices)]
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+
+                index, results, latency = future.result()
+                slice_results[index] = results
+                slice_stats[index]["status"] = "done"
+                slice_stats[index]["latency_ms"] = round(latency, 1)
+
+                for rows in ("logon_info", "logon_counts", "logon_summary"):
+                    size += len(results.get(rows, []))
+                if self.result_budget is not None and size >= self.result_budget:
+                    budget_reached = True
+                    for pending in futures:
+                        pending.cancel()
+
+        results = self._merge_slices([r for r in slice_results if r is not None])
+        results["slices"] = slice_stats
+        results["budget_reached"] = budget_reached
+
+        return results
+
+    def _merge_slices(self, slice_results):
+        noun = SERVICE_FIELDS[self.service][2]
+        results = dict()
+
+        total = 0
+        for outcome in ("successful", "unsuccessful"):
+            key = f"{outcome}_logon_{noun}"
+            if any(key in r for r in slice_results):
+                results[key] = sorted(
+                    set().union(*(r.get(key, []) for r in slice_results))
+                )
+                total += len(results[key])
+        results[f"total_{noun}"] = total
+
+        if self.mode == "aggregate":
+            counts = dict()
+            for r in slice_results:
+                for key, key_counts in r["logon_counts"].items():
+                    merged = counts.setdefault(key, dict())
+                    for outcome, count in key_counts.items():
+                        merged[outcome] = merged.get(outcome, 0) + count
+            results[f"unique_{noun}"] = len(counts)
+            results["logon_counts"] = counts
+            results["aggregation_pages"] = sum(
+                r["aggregation_pages"] for r in slice_results
             )
-            results["total_users"] = len(results["successful_logon_users"]) + len(
-                results["unsuccessful_logon_users"]
+        elif self.mode == "summary":
+            merged = dict()
+            for r in slice_results:
+                for group in r["logon_summary"]:
+                    identity = tuple(
+                        (key, value)
+                        for key, value in group.items()
+                        if key not in ("count", "first_seen", "last_seen")
+                    )
+                    if identity not in merged:
+                        merged[identity] = dict(group)
+                    else:
+                        seen = merged[identity]
+                        seen["count"] += group["count"]
+                        seen["first_seen"] = min(
+                            seen["first_seen"], group["first_seen"]
+                        )
+                        seen["last_seen"] = max(seen["last_seen"], group["last_seen"])
+            results.update(self._bound_summary(list(merged.values())))
+            results["aggregation_pages"] = sum(
+                r["aggregation_pages"] for r in slice_results
             )
-
-        elif self.service == "cisco-vpn-ip-login-users":
-            data = {
-                "_source": ["user.name", "source.ip", "@timestamp"],
-                "sort": [{"@timestamp": {"order": "desc"}}],
-                "size": MAX_RESULT_SIZE,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"exists": {"field": "source.ip"}},
-                            {"exists": {"field": "user.name"}},
-                            {"match": {"source.ip": self.data}},
-                            {"match": {"cisco.asa.message_id": CISCO_VPN_MESSAGE_ID}},
-                        ],
-                        "filter": {
-                            "range": {"@timestamp": {"gte": f"now-{self.hours}h"}}
-                        },
-                    }
-                },
+        else:
+            results["logon_info"] = [
+                item for r in slice_results for item in r["logon_info"]
+            ]
+
+        if self.mode == "stream":
+            results["stream"] = {
+                "rows": sum(r["stream"]["rows"] for r in slice_results),
+                "bytes": sum(r["stream"]["bytes"] for r in slice_results),
+                "pages": sum(r["stream"]["pages"] for r in slice_results),
+                "truncated": any(r["stream"]["truncated"] for r in slice_results),
             }
 
-            json_data = self._get_response(data)
-
-            results["successful_logon_users"] = set()
-            results["logon_info"] = list()
-
-            for hit in json_data["hits"]["hits"]:
-                user = hit["_source"]["user"]["name"]
-
-                item = {"timestamp": hit["_source"]["@timestamp"], "user": user}
-                results["successful_logon_users"].add(user)
-
-                results["logon_info"].append(item)
-
-            results["successful_logon_users"] = list(results["successful_logon_users"])
-            results["total_users"] = len(results["successful_logon_users"])
-
-        elif self.service == "cisco-vpn-user-login-ips":
-            data = {
-                "_source": ["user.name", "source.ip", "@timestamp"],
-                "sort": [{"@timestamp": {"order": "desc"}}],
-                "size": MAX_RESULT_SIZE,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"exists": {"field": "source.ip"}},
-                            {"exists": {"field": "user.name"}},
-                            {"match": {"user.name": self.data}},
-                            {"match": {"cisco.asa.message_id": CISCO_VPN_MESSAGE_ID}},
-                        ],
-                        "filter": {
-                            "range": {"@timestamp": {"gte": f"now-{self.hours}h"}}
-                        },
-                    }
-                },
-            }
+        return results
 
-            if must_not is not None:
-                data["query"]["bool"]["must_not"] = must_not
+    def _build_search_body(self, observable, time_range=None):
+        data = {
+            "_source": self._source_fields(),
+            "sort": [{"@timestamp": {"order": "desc"}}],
+            "size": MAX_RESULT_SIZE,
+            "query": compile_query(
+                self.service, observable, self.hours, self.ignore_ips, time_range
+            ),
+        }
 
-            json_data = self._get_response(data)
+        if self.slim:
+            data["_source"] = False
+            data["docvalue_fields"] = [
+                (
+                    {"field": field, "format": "strict_date_optional_time"}
+                    if field == "@timestamp"
+                    else field
+                )
+                for field in self._source_fields()
+            ]
+
+        return data
+
+    def _source_fields(self):
+        if self.service in WINDOWS_SERVICES:
+            return WINDOWS_SOURCE_FIELDS
+        return CISCO_SOURCE_FIELDS
+
+    def _parse_hits(self, hits):
+        """Parse Hits
+        Build the report from search hits, full "_source" or slim docvalue hits,
+        both flattened by extract_fields.
+        """
+        key_field = SERVICE_FIELDS[self.service][1]
+        noun = SERVICE_FIELDS[self.service][2]
+        item_key = noun[:-1]
+        fields = self._source_fields()
+
+        successful = set()
+        unsuccessful = set()
+        logon_info = list()
+
+        for hit in hits:
+            hit = extract_fields(hit, fields)
+            key = hit[key_field]
+
+            if self.service not in WINDOWS_SERVICES:
+                successful.add(key)
+                logon_info.append({"timestamp": hit["@timestamp"], item_key: key})
+                continue
+
+            event_code = hit["event.code"]
+
+            item = {
+                "host": hit["agent.hostname"],
+                "timestamp": hit["@timestamp"],
+                item_key: key,
+                "event_code": event_code,
+            }
 
-            results["successful_logon_ips"] = set()
-            results["logon_info"] = list()
+            if str(event_code) == str(WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE):
+                successful.add(key)
+                item["outcome"] = "success"
 
-            for hit in json_data["hits"]["hits"]:
-                ip = hit["_source"]["source"]["ip"]
+            else:
+                unsuccessful.add(key)
+                item["outcome"] = "failure"
+
+            if "winlog.event_data.LogonType" in hit:
+                logon_type = hit["winlog.event_data.LogonType"]
+                item["logon_type"] = logon_type
+                item["verbose_logon_type"] = WINDOWS_SUCCESSFUL_LOGON_TYPES.get(
+                    logon_type, "unknown"
+                )
+            if "winlog.event_data.SubStatus" in hit:
+                substatus = hit["winlog.event_data.SubStatus"]
+                item["substatus"] = substatus
+                item["verbose_substatus"] = WINDOWS_UNSUCCESSFUL_LOGON_CODES.get(
+                    substatus, "unknown"
+                )
+
+            logon_info.append(item)
+
+        results = {f"successful_logon_{noun}": list(successful)}
+        if self.service in WINDOWS_SERVICES:
+            results[f"unsuccessful_logon_{noun}"] = list(unsuccessful)
+        results["logon_info"] = logon_info
+        results[f"total_{noun}"] = len(successful) + len(unsuccessful)
+
+        return results
+
+    def _aggregate(self, query):
+        """Aggregate
+        Count logons per returned user/IP (and per event code for Windows) with a
+        composite aggregation.  No hits are returned.
+        """
+        key_field, noun = SERVICE_FIELDS[self.service][1:]
+
+        sources = [{"key": {"terms": {"field": key_field}}}]
+        if self.service in WINDOWS_SERVICES:
+            sources.append({"event_code": {"terms": {"field": "event.code"}}})
+
+        counts = dict()
+        stats = {"pages": 0}
+        for bucket in self._composite_buckets(query, sources, stats):
+            key = bucket["key"]["key"]
+            outcome = "successful"
+            if "event_code" in bucket["key"] and str(
+                bucket["key"]["event_code"]
+            ) != str(WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE):
+                outcome = "unsuccessful"
+
+            key_counts = counts.setdefault(key, dict())
+            key_counts[outcome] = key_counts.get(outcome, 0) + bucket["doc_count"]
 
-                item = {
-                    "timestamp": hit["_source"]["@timestamp"],
-                    "ip": ip,
-                }
-                results["successful_logon_ips"].add(ip)
-
-                results["logon_info"].append(item)
-
-            results["successful_logon_ips"] = list(results["successful_logon_ips"])
-            results["total_ips"] = len(results["successful_logon_ips"])
-
-        elif self.service == "windows-user-login-ips":
-            # search for user logons
-            data = {
-                "_source": [
-                    "source.ip",
-                    "agent.hostname",
-                    "winlog.event_data.LogonType",
-                    "@timestamp",
-                    "event.code",
-                    "winlog.event_data.SubStatus",
-                    "user.name",
-                ],
-                "sort": [{"@timestamp": {"order": "desc"}}],
-                "size": MAX_RESULT_SIZE,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"exists": {"field": "source.ip"}},
-                            {"exists": {"field": "user.name"}},
-                            {"exists": {"field": "agent.hostname"}},
-                            {"match": {"user.name": self.data}},
-                        ],
-                        "should": [
-                            {
-                                "match": {
-                                    "event.code": WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE
-                                }
-                            },
-                            {
-                                "match": {
-                                    "event.code": WINDOWS_UNSUCCESSFUL_LOGON_EVENT_CODE
-                                }
-                            },
-                        ],
-                        "minimum_should_match": 1,
-                        "filter": {
-                            "range": {"@timestamp": {"gte": f"now-{self.hours}h"}}
-                        },
+        results = dict()
+        results[f"successful_logon_{noun}"] = sorted(
+            key for key, value in counts.items() if "successful" in value
+        )
+        total = len(results[f"successful_logon_{noun}"])
+        if self.service in WINDOWS_SERVICES:
+            results[f"unsuccessful_logon_{noun}"] = sorted(
+                key for key, value in counts.items() if "unsuccessful" in value
+            )
+            total += len(results[f"unsuccessful_logon_{noun}"])
+        results[f"total_{noun}"] = total
+        results[f"unique_{noun}"] = len(counts)
+        results["logon_counts"] = counts
+        results["aggregation_pages"] = stats["pages"]
+
+        return results
+
+    def _summarize(self, query, bound=True):
+        """Summarize
+        Group logons by host, user/IP, outcome, logon type and substatus with a
+        composite aggregation, each group carrying its count and first/last seen
+        @timestamp from min/max sub-aggregations.  The unique user/IP lists cover
+        every group, logon_summary keeps the MAX_SUMMARY_GROUPS largest groups.
+        With bound False only the untruncated logon_summary is returned, for
+        slices that are merged and bounded afterwards.
+        """
+        key_field, noun = SERVICE_FIELDS[self.service][1:]
+        item_key = noun[:-1]
+        windows = self.service in WINDOWS_SERVICES
+
+        sources = [{"key": {"terms": {"field": key_field}}}]
+        if windows:
+            sources += [
+                {"host": {"terms": {"field": "agent.hostname"}}},
+                {"event_code": {"terms": {"field": "event.code"}}},
+                {
+                    "logon_type": {
+                        "terms": {
+                            "field": "winlog.event_data.LogonType",
+                            "missing_bucket": True,
+                        }
                     }
                 },
-            }
-
-            if must_not is not None:
-                data["query"]["bool"]["must_not"] = must_not
-
-            json_data = self._get_response(data)
-
-            results["successful_logon_ips"] = set()
-            results["unsuccessful_logon_ips"] = set()
-            results["logon_info"] = list()
-
-            for hit in json_data["hits"]["hits"]:
-                ip = hit["_source"]["source"]["ip"]
-                event_code = hit["_source"]["event"]["code"]
-
-                item = {
-                    "host": hit["_source"]["agent"]["hostname"],
-                    "timestamp": hit["_source"]["@timestamp"],
-                    "ip": ip,
-                    "event_code": event_code,
-                }
-
-                if event_code == WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE:
-                    results["successful_logon_ips"].add(ip)
-                    item["outcome"] = "success"
+                {
+                    "substatus": {
+                        "terms": {
+                            "field": "winlog.event_data.SubStatus",
+                            "missing_bucket": True,
+                        }
+                    }
+                },
+            ]
+        aggs = {
+            "first_seen": {"min": {"field": "@timestamp"}},
+            "last_seen": {"max": {"field": "@timestamp"}},
+        }
 
+        groups = list()
+        stats = {"pages": 0}
+        for bucket in self._composite_buckets(query, sources, stats, aggs):
+            key = bucket["key"]
+            group = dict()
+
+            if windows:
+                group["host"] = key["host"]
+                group[item_key] = key["key"]
+                group["event_code"] = key["event_code"]
+                if str(key["event_code"]) == str(WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE):
+                    group["outcome"] = "success"
                 else:
-                    results["unsuccessful_logon_ips"].add(ip)
-                    item["outcome"] = "failure"
-
-                if "LogonType" in hit["_source"]["winlog"]["event_data"]:
-                    logon_type = hit["_source"]["winlog"]["event_data"]["LogonType"]
-                    item["logon_type"] = logon_type
-                    item["verbose_logon_type"] = WINDOWS_SUCCESSFUL_LOGON_TYPES.get(
-                        logon_type, "unknown"
+                    group["outcome"] = "failure"
+                if key["logon_type"] is not None:
+                    group["logon_type"] = key["logon_type"]
+                    group["verbose_logon_type"] = WINDOWS_SUCCESSFUL_LOGON_TYPES.get(
+                        key["logon_type"], "unknown"
                     )
-                if "SubStatus" in hit["_source"]["winlog"]["event_data"]:
-                    substatus = hit["_source"]["winlog"]["event_data"]["SubStatus"]
-                    item["substatus"] = substatus
-                    item["verbose_substatus"] = WINDOWS_UNSUCCESSFUL_LOGON_CODES.get(
-                        substatus, "unknown"
+                if key["substatus"] is not None:
+                    group["substatus"] = key["substatus"]
+                    group["verbose_substatus"] = WINDOWS_UNSUCCESSFUL_LOGON_CODES.get(
+                        key["substatus"], "unknown"
                     )
+            else:
+                group[item_key] = key["key"]
+                group["outcome"] = "success"
 
-                results["logon_info"].append(item)
+            group["count"] = bucket["doc_count"]
+            for seen in ("first_seen", "last_seen"):
+                group[seen] = bucket[seen].get("value_as_string", bucket[seen]["value"])
 
-            results["successful_logon_ips"] = list(results["successful_logon_ips"])
-            results["unsuccessful_logon_ips"] = list(results["unsuccessful_logon_ips"])
-            results["total_ips"] = len(results["successful_logon_ips"]) + len(
-                results["unsuccessful_logon_ips"]
-            )
+            groups.append(group)
 
-        self.report(results)
+        if bound:
+            results = self._bound_summary(groups)
+        else:
+            results = {"logon_summary": groups}
+        results["aggregation_pages"] = stats["pages"]
+
+        return results
 
-    def _get_response(self, data):
-        response = requests.get(
-            self.url + "/" + self.index + "/_search",
-            headers=self.headers,
+    def _bound_summary(self, groups):
+        noun = SERVICE_FIELDS[self.service][2]
+        item_key = noun[:-1]
+
+        results = dict()
+        results[f"successful_logon_{noun}"] = sorted(
+            {group[item_key] for group in groups if group["outcome"] == "success"}
+        )
+        total = len(results[f"successful_logon_{noun}"])
+        if self.service in WINDOWS_SERVICES:
+            results[f"unsuccessful_logon_{noun}"] = sorted(
+                {group[item_key] for group in groups if group["outcome"] == "failure"}
+            )
+            total += len(results[f"unsuccessful_logon_{noun}"])
+        results[f"total_{noun}"] = total
+
+        # largest groups first, most recently seen first within the same count
+        groups.sort(key=lambda group: group["last_seen"], reverse=True)
+        groups.sort(key=lambda group: group["count"], reverse=True)
+        results["logon_summary"] = groups[:MAX_SUMMARY_GROUPS]
+        results["summary_groups"] = len(groups)
+        results["summary_truncated"] = len(groups) > MAX_SUMMARY_GROUPS
+
+        return results
+
+    def _composite_buckets(self, query, sources, stats, aggs=None):
+        """Composite Buckets
+        Yield every bucket of a size 0 composite aggregation over query, walking
+        pages with the composite "after_key" until every bucket has been seen.
+        """
+        after_key = None
+
+        while True:
+            composite = {"size": AGGREGATION_PAGE_SIZE, "sources": sources}
+            if after_key is not None:
+                composite["after"] = after_key
+
+            aggregation = {"composite": composite}
+            if aggs is not None:
+                aggregation["aggs"] = aggs
+
+            json_data = self._get_response(
+                {"size": 0, "query": query, "aggs": {"logons": aggregation}}
+            )
+            aggregation = json_data["aggregations"]["logons"]
+            stats["pages"] += 1
+
+            yield from aggregation["buckets"]
+
+            after_key = aggregation.get("after_key")
+            if after_key is None or len(aggregation["buckets"]) == 0:
+                break
+
+    def _stream_hits(self, data, stats, budget=None):
+        """Stream Hits
+        Yield hits for a search body one page at a time using a point in time and
+        search_after on @timestamp.  Stops after max_rows hits or once max_bytes of
+        response bodies have been read (checked after each page), "truncated" in
+        stats is set if either cap was hit.  Slices pass the StreamBudget they
+        share so the caps cover all of them.
+        """
+        body = dict(data)
+        body["track_total_hits"] = False
+        if budget is None:
+            budget = StreamBudget(self.max_rows, self.max_bytes)
+
+        stats.update({"rows": 0, "bytes": 0, "pages": 0, "truncated": False})
+
+        pit_id = self._open_point_in_time()
+        try:
+            while True:
+                body["size"] = budget.reserve(STREAM_PAGE_SIZE)
+                if body["size"] == 0:
+                    stats["truncated"] = True
+                    return
+                body["pit"] = {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE}
+                response = self._request(
+                    "post", "/_search", json=body, params=self._search_params()
+                )
+                stats["bytes"] += len(response.content)
+                stats["pages"] += 1
+
+                json_data = response.json()
+                pit_id = json_data.get("pit_id", pit_id)
+                hits = json_data.get("hits", {}).get("hits", [])
+                # unused rows go back for the other slices
+                budget.release(body["size"] - len(hits), len(response.content))
+                del json_data, response
+
+                for hit in hits:
+                    stats["rows"] += 1
+                    yield hit
+
+                if len(hits) < body["size"]:
+                    return
+
+                body["search_after"] = hits[-1]["sort"]
+        finally:
+            self._close_point_in_time(pit_id)
+
+    def _open_point_in_time(self):
+        response = self._request(
+            "post",
+            "/" + self.index + "/_pit",
+            params={"keep_alive": PIT_KEEP_ALIVE},
+        )
+        return response.json()["id"]
+
+    def _close_point_in_time(self, pit_id):
+        # best effort, the point in time expires after PIT_KEEP_ALIVE anyway
+        try:
+            requests.delete(
+                self.url + "/_pit",
+                headers=self.headers,
+                auth=(self.username, self.password),
+                json={"id": pit_id},
+                proxies=self.proxies,
+                verify=self.verify,
+            )
+        except requests.RequestException:
+            pass
+
+    def _get_response(self, data, slim=False):
+        params = None
+        if slim:
+            params = self._search_params()
+        return self._request(
+            "get", "/" + self.index + "/_search", json=data, params=params
+        ).json()
+
+    def _search_params(self):
+        if self.slim:
+            return {"filter_path": SLIM_FILTER_PATH}
+        return None
+
+    def _request(self, method, path, headers=None, **kwargs):
+        response = requests.request(
+            method,
+            self.url + path,
+            headers=headers or self.headers,
             auth=(self.username, self.password),
-            json=data,
             proxies=self.proxies,
             verify=self.verify,
+            **kwargs,
         )
         if response.status_code != requests.codes.ok:
-            self.error(f"Unable to complete request. Status code: {status_code}")
-
-        return response.json()
-
-    def _build_ignore_ips(self):
-        if len(self.ignore_ips) == 0:
-            return None
+            self.error(
+                f"Unable to complete request. Status code: {response.status_code}"
+            )
 
-        must_not = list()
-        for ip in self.ignore_ips:
-            if IGNORE_IPS_SAFE_CHARS.match(ip) is None:
-                self.error(f"Ignore IP does not match safe characters: {ip}")
-            else:
-                must_not.append({"match": {"source.ip": ip}})
-        return must_not
+        return response
 
 
 if __name__ == "__main__":
@@ -1,18 +1,886 @@
 #!/usr/bin/env python3
 
+import base64
+import fcntl
+import hashlib
+import json
 import os
 import random
-import string
+import shutil
+import signal
+import socket
+import sqlite3
 import subprocess
 import tempfile
-from pathlib import Path
-from shutil import copyfileobj
-from urllib.parse import urlsplit
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
 
 import iocextract
 from cortexutils.analyzer import Analyzer
 
-SERVICES = ("screenshot", "dom")
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+# seconds to wait after a load for the main frame to navigate again
+CLIENT_REDIRECT_WAIT = 3
+DEFAULT_ADMISSION_TIMEOUT = 300
+DEFAULT_BLOCK_RESOURCE_TYPES = ("Image", "Media", "Font")
+DEFAULT_CACHE_MAX_BYTES = 500 * 1024 * 1024
+DEFAULT_CACHE_TTL = 900
+DEFAULT_DOM_WAIT_TIMEOUT = 10
+DEFAULT_DOM_WAIT_UNTIL = "networkIdle"
+DEFAULT_MAX_BROWSERS = 4
+DEFAULT_POOL_MAX_MEMORY_MB = 1024
+DEFAULT_POOL_MAX_PAGES = 100
+DEFAULT_PROFILE_POOL_SIZE = 2
+DEFAULT_RENDER_TIMEOUT = 60
+DEFAULT_SCREENSHOT_FORMAT = "png"
+DEFAULT_SCREENSHOT_QUALITY = 80
+DEFAULT_THUMBNAIL_WIDTH = 320
+DEFAULT_PORTS = {"http": 80, "https": 443}
+DEVTOOLS_START_TIMEOUT = 10
+LIFECYCLE_EVENTS = ("DOMContentLoaded", "load", "networkAlmostIdle", "networkIdle")
+MAX_BLOCKED_REPORTED = 500
+MAX_BUFFERED_EVENTS = 10000
+MAX_CLIENT_REDIRECTS = 10
+MAX_SCREENSHOT_TILES = 20
+# report sections describing a single run, never cached
+RUN_SECTIONS = ("cache", "pool", "profile", "timing")
+SCREENSHOT_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+SERVICES = ("screenshot", "dom", "capture")
+SHM_PATH = "/dev/shm"
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class DevToolsError(Exception):
+    pass
+
+
+class DevToolsTimeout(DevToolsError):
+    pass
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+class DevTools:
+    """DevTools
+    Minimal Chrome DevTools protocol client over a browser's websocket.  Commands
+    are sent with send() and answered in order, events that arrive meanwhile are
+    buffered for wait_for() unless a handler is registered for them with on().
+    Once deadline (monotonic) passes every call raises RenderTimeout.
+    """
+
+    def __init__(self, ws_url, timeout, deadline=None):
+        if websocket is None:
+            raise DevToolsError("websocket-client is not installed")
+
+        self.timeout = timeout
+        self.deadline = deadline
+        self.next_id = 0
+        self.events = deque(maxlen=MAX_BUFFERED_EVENTS)
+        self.handlers = dict()
+        try:
+            # cortexutils exports config.proxy to the environment, the browser
+            # is local so connect directly rather than let websocket-client
+            # tunnel through it
+            address = urlsplit(ws_url)
+            self.socket = websocket.create_connection(
+                ws_url,
+                timeout=timeout,
+                suppress_origin=True,
+                socket=socket.create_connection(
+                    (address.hostname, address.port), timeout
+                ),
+            )
+        except (OSError, websocket.WebSocketException) as e:
+            raise DevToolsError(f"Unable to connect to {ws_url}: {e}")
+
+    def close(self):
+        try:
+            self.socket.close()
+        except (OSError, websocket.WebSocketException):
+            pass
+
+    def on(self, method, handler):
+        """On
+        Call handler with each event named method as it arrives instead of
+        buffering it.  Handlers may post() but not send().
+        """
+        self.handlers[method] = handler
+
+    def post(self, method, params=None, session_id=None):
+        """Post
+        Send a command without waiting for its result, returns its id.
+        """
+        self.next_id += 1
+        message = {"id": self.next_id, "method": method, "params": params or {}}
+        if session_id is not None:
+            message["sessionId"] = session_id
+
+        try:
+            self.socket.send(json.dumps(message))
+        except (OSError, websocket.WebSocketException) as e:
+            raise DevToolsError(f"{method} failed: {e}")
+        return self.next_id
+
+    def send(self, method, params=None, session_id=None, timeout=None):
+        message_id = self.post(method, params, session_id)
+
+        deadline = time.monotonic() + (timeout or self.timeout)
+        while True:
+            message = self._receive(deadline, method)
+            if message.get("id") == message_id:
+                if "error" in message:
+                    raise DevToolsError(
+                        f"{method} failed: {message['error'].get('message')}"
+                    )
+                return message.get("result", {})
+            if "method" in message:
+                self.events.append(message)
+
+    def wait_for(self, method, session_id=None, timeout=None, match=None):
+        """Wait For
+        Returns the first event named method (for session_id if given, and whose
+        params match if given), buffered or yet to arrive.  Raises
+        DevToolsTimeout if none arrives within timeout seconds.
+        """
+
+        def matches(event):
+            return self._matches(event, method, session_id) and (
+                match is None or match(event["params"])
+            )
+
+        for event in list(self.events):
+            if matches(event):
+                self.events.remove(event)
+                return event
+
+        deadline = time.monotonic() + (timeout or self.timeout)
+        while True:
+            message = self._receive(deadline, method)
+            if "method" not in message:
+                continue
+            if matches(message):
+                return message
+            self.events.append(message)
+
+    def drain(self, method, session_id=None):
+        """Drain
+        Removes and returns the buffered events named method (for session_id if
+        given), oldest first.
+        """
+        events = [e for e in self.events if self._matches(e, method, session_id)]
+        for event in events:
+            self.events.remove(event)
+        return events
+
+    def _matches(self, event, method, session_id):
+        return event["method"] == method and (
+            session_id is None or event.get("sessionId") == session_id
+        )
+
+    def _receive(self, deadline, waiting_for):
+        timeout_error = DevToolsTimeout
+        if self.deadline is not None and self.deadline <= deadline:
+            deadline = self.deadline
+            timeout_error = RenderTimeout
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise timeout_error(f"Timed out waiting for {waiting_for}")
+
+            self.socket.settimeout(remaining)
+            try:
+                message = json.loads(self.socket.recv())
+            except websocket.WebSocketTimeoutException:
+                raise timeout_error(f"Timed out waiting for {waiting_for}")
+            except (OSError, ValueError, websocket.WebSocketException) as e:
+                raise DevToolsError(f"DevTools connection failed: {e}")
+
+            if message.get("method") in self.handlers:
+                self.handlers[message["method"]](message)
+            else:
+                return message
+
+
+def launch_browser(binary_path, user_data_dir, extra_args=()):
+    """Launch Browser
+    Start headless Chromium in its own process group with remote debugging on a
+    free port.  Returns the process and the browser's DevTools websocket URL.
+    """
+    port_file = os.path.join(user_data_dir, "DevToolsActivePort")
+    if os.path.exists(port_file):
+        os.unlink(port_file)
+
+    try:
+        process = subprocess.Popen(
+            [
+                binary_path,
+                "--headless",
+                "--remote-debugging-port=0",
+                "--user-data-dir=" + user_data_dir,
+                "--no-first-run",
+                "--no-default-browser-check",
+                *extra_args,
+                "about:blank",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        raise DevToolsError(f"Unable to start {binary_path}: {e}")
+
+    deadline = time.monotonic() + DEVTOOLS_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise DevToolsError(f"Browser exited with {process.returncode}")
+        try:
+            with open(port_file) as f:
+                port, path = f.read().split()[:2]
+            return process, f"ws://127.0.0.1:{port}{path}"
+        except (OSError, ValueError):
+            time.sleep(0.05)
+
+    kill_process_group(process.pid)
+    raise DevToolsError("Browser did not open a DevTools port")
+
+
+def lock_slot(path, prefix, size):
+    """Lock Slot
+    Try to lock one of size lock files in path without blocking.  Returns the
+    slot number and its open lock file, or None if every slot is locked.
+    """
+    for slot in random.sample(range(size), size):
+        lock = open(os.path.join(path, f"{prefix}-{slot}.lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot, lock
+        except BlockingIOError:
+            lock.close()
+    return None
+
+
+def unlock_slot(lock):
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+
+
+def memory_available():
+    """Memory Available
+    MemAvailable from /proc/meminfo in bytes, None if it can't be read.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def disk_usage(path):
+    usage = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                usage += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                continue
+    return usage
+
+
+def normalize_url(url):
+    """Normalize URL
+    Lower case scheme and host and drop the default port, so trivially different
+    submissions of a URL match.  Path, query and fragment are kept as sent, the
+    page's scripts can read all of them.
+    """
+    parts = urlsplit(url.strip())
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+
+    netloc = parts.hostname or ""
+    if ":" in netloc:
+        netloc = f"[{netloc}]"
+    if port is not None and port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        netloc = f"{netloc}:{port}"
+    if "@" in parts.netloc:
+        netloc = parts.netloc.rsplit("@", 1)[0] + "@" + netloc
+
+    return urlunsplit(
+        (parts.scheme.lower(), netloc, parts.path, parts.query, parts.fragment)
+    )
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def kill_process_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def process_group_rss(pgid):
+    """Process Group RSS
+    Resident memory in bytes of every process in a process group (the browser
+    and its renderers).
+    """
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    rss = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # pgrp is the 3rd field after "pid (comm)"
+                fields = f.read().rsplit(")", 1)[1].split()
+            if int(fields[2]) != pgid:
+                continue
+            with open(f"/proc/{pid}/statm") as f:
+                rss += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss
+
+
+class Admission:
+    """Admission
+    Host wide cap on browsers started for a single job.  Each browser holds one
+    of max_browsers lock files while it runs and, with min_free_memory_mb set,
+    is only started while MemAvailable is above it.  Jobs wait up to timeout
+    seconds to be admitted.
+    """
+
+    def __init__(self, path, max_browsers, min_free_memory_mb, timeout):
+        self.path = path
+        self.max_browsers = max_browsers
+        self.min_free_memory = min_free_memory_mb * 1024 * 1024
+        self.timeout = timeout
+        os.makedirs(path, exist_ok=True)
+
+    @contextmanager
+    def admit(self):
+        """Admit
+        Hold a browser slot for the duration of the with block, yields seconds
+        spent waiting for it.
+        """
+        started = time.monotonic()
+        while True:
+            locked = lock_slot(self.path, "browser", self.max_browsers)
+            if locked is not None:
+                available = memory_available()
+                if available is None or available >= self.min_free_memory:
+                    break
+                unlock_slot(locked[1])
+
+            if time.monotonic() - started > self.timeout:
+                raise AdmissionError(
+                    f"No browser admitted after {self.timeout} seconds"
+                )
+            time.sleep(0.1)
+
+        try:
+            yield time.monotonic() - started
+        finally:
+            unlock_slot(locked[1])
+
+
+class ProfileManager:
+    """Profile Manager
+    Profiles for browsers started per job, cloned from a template profile the
+    browser initialised once (rebuilt when the binary changes) instead of
+    starting from nothing each run.  size clones are kept ready, a job takes one
+    with a rename and its profile is deleted when the job ends.  Profiles left
+    behind by jobs that died are swept on the next acquire.
+    """
+
+    def __init__(self, path, size, binary_path):
+        self.path = path
+        self.size = size
+        self.binary_path = binary_path
+        self.template = os.path.join(path, "template")
+        self.ready = os.path.join(path, "ready")
+        self.jobs = os.path.join(path, "jobs")
+        os.makedirs(self.ready, exist_ok=True)
+        os.makedirs(self.jobs, exist_ok=True)
+
+    def acquire(self, timeout):
+        """Acquire
+        A profile for this job, from the ready clones if possible.  Returns its
+        path and whether it was a ready clone.
+        """
+        self._sweep()
+        with self._lock():
+            self._build_template(timeout)
+
+        profile = self._job_path()
+        for name in os.listdir(self.ready):
+            try:
+                os.rename(os.path.join(self.ready, name), profile)
+                hit = True
+                break
+            except FileNotFoundError:
+                # taken by another job
+                continue
+        else:
+            shutil.copytree(self.template, profile, symlinks=True)
+            hit = False
+
+        with self._lock():
+            stats = self._stats()
+            stats["hits" if hit else "misses"] += 1
+            self._save_stats(stats)
+        return profile, hit
+
+    def release(self, profile):
+        """Release
+        Delete the job's profile and top the ready clones back up.
+        """
+        shutil.rmtree(profile, ignore_errors=True)
+        with self._lock():
+            for _ in range(self.size - len(os.listdir(self.ready))):
+                # clone beside the jobs so a half copy is swept, never taken
+                staging = self._job_path()
+                shutil.copytree(self.template, staging, symlinks=True)
+                os.rename(staging, os.path.join(self.ready, os.path.basename(staging)))
+
+    def metrics(self, hit):
+        with self._lock():
+            stats = self._stats()
+        return {
+            "hit": hit,
+            "hits": stats["hits"],
+            "misses": stats["misses"],
+            "swept": stats["swept"],
+            "ready": len(os.listdir(self.ready)),
+            "disk_usage_mb": round(disk_usage(self.path) / 1024 / 1024, 1),
+        }
+
+    def _build_template(self, timeout):
+        try:
+            binary_mtime = os.stat(self.binary_path).st_mtime
+        except OSError:
+            binary_mtime = None
+        marker = {"binary_path": self.binary_path, "binary_mtime": binary_mtime}
+        try:
+            with open(os.path.join(self.template, ".template.json")) as f:
+                if json.load(f) == marker:
+                    return
+        except (OSError, ValueError):
+            pass
+
+        staging = self._job_path()
+        os.makedirs(staging)
+        process = subprocess.Popen(
+            [
+                self.binary_path,
+                "--headless",
+                "--user-data-dir=" + staging,
+                "--no-first-run",
+                "--no-default-browser-check",
+                "--dump-dom",
+                "about:blank",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            pass
+        finally:
+            kill_process_group(process.pid)
+            process.wait()
+
+        # the browser's singleton lock links would make clones look in use
+        for name in os.listdir(staging):
+            if name.startswith("Singleton") or name == "DevToolsActivePort":
+                os.unlink(os.path.join(staging, name))
+        with open(os.path.join(staging, ".template.json"), "w") as f:
+            json.dump(marker, f)
+
+        for name in os.listdir(self.ready):
+            shutil.rmtree(os.path.join(self.ready, name), ignore_errors=True)
+        shutil.rmtree(self.template, ignore_errors=True)
+        os.rename(staging, self.template)
+
+    def _sweep(self):
+        for name in os.listdir(self.jobs):
+            try:
+                os.kill(int(name.split("-")[0]), 0)
+                continue
+            except PermissionError:
+                continue
+            except (ProcessLookupError, ValueError):
+                pass
+            shutil.rmtree(os.path.join(self.jobs, name), ignore_errors=True)
+            with self._lock():
+                stats = self._stats()
+                stats["swept"] += 1
+                self._save_stats(stats)
+
+    def _job_path(self):
+        return os.path.join(self.jobs, f"{os.getpid()}-{os.urandom(6).hex()}")
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.path, "profiles.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _stats(self):
+        try:
+            with open(os.path.join(self.path, "stats.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0, "swept": 0}
+
+    def _save_stats(self, stats):
+        path = os.path.join(self.path, "stats.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(stats, f)
+        os.replace(path + ".tmp", path)
+
+
+class BrowserPool:
+    """Browser Pool
+    Long lived headless browsers shared by every job on the host, one per slot.
+    A job locks a free slot, health checks its browser over DevTools (starting a
+    new one if needed) and renders in its own browser context.  A browser is
+    recycled after max_pages pages or once its processes use more than
+    max_memory_mb.  Slot state lives in JSON files next to the slot locks.
+    """
+
+    def __init__(
+        self,
+        path,
+        size,
+        binary_path,
+        max_pages,
+        max_memory_mb,
+        timeout,
+        acquire_timeout,
+    ):
+        self.path = path
+        self.size = size
+        self.binary_path = binary_path
+        self.max_pages = max_pages
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        os.makedirs(path, exist_ok=True)
+
+    def acquire(self):
+        """Acquire
+        Lock a free slot, waiting up to acquire_timeout seconds if all are busy.
+        Returns the slot number and its open lock file, release() unlocks it.
+        """
+        started = time.monotonic()
+        while True:
+            locked = lock_slot(self.path, "slot", self.size)
+            if locked is not None:
+                return locked
+            if time.monotonic() - started > self.acquire_timeout:
+                raise AdmissionError(
+                    f"No pool browser free after {self.acquire_timeout} seconds"
+                )
+            time.sleep(0.1)
+
+    def release(self, lock):
+        unlock_slot(lock)
+
+    def connect(self, slot):
+        """Connect
+        DevTools connection to the slot's browser, started (or restarted if it
+        fails the health check) as needed.  Returns the connection and slot state.
+        """
+        state = self._load(slot)
+        if state is not None:
+            try:
+                os.kill(state["pid"], 0)
+                devtools = DevTools(state["ws_url"], self.timeout)
+                devtools.send("Browser.getVersion")
+                return devtools, state
+            except (OSError, DevToolsError):
+                self.recycle(slot, state)
+
+        user_data_dir = os.path.join(self.path, f"profile-{slot}")
+        shutil.rmtree(user_data_dir, ignore_errors=True)
+        os.makedirs(user_data_dir)
+        process, ws_url = launch_browser(self.binary_path, user_data_dir)
+        state = {
+            "pid": process.pid,
+            "ws_url": ws_url,
+            "user_data_dir": user_data_dir,
+            "pages": 0,
+            "started": time.time(),
+        }
+        self._save(slot, state)
+        return DevTools(ws_url, self.timeout), state
+
+    def finish(self, slot, state):
+        """Finish
+        Count a page against the slot's browser and recycle it if it is due.
+        Returns the browser's RSS in bytes and whether it was recycled.
+        """
+        state["pages"] += 1
+        rss = process_group_rss(state["pid"])
+        if state["pages"] >= self.max_pages or rss > self.max_memory:
+            self.recycle(slot, state)
+            return rss, True
+
+        self._save(slot, state)
+        return rss, False
+
+    def recycle(self, slot, state):
+        kill_process_group(state["pid"])
+        shutil.rmtree(state["user_data_dir"], ignore_errors=True)
+        try:
+            os.unlink(os.path.join(self.path, f"slot-{slot}.json"))
+        except FileNotFoundError:
+            pass
+
+    def _load(self, slot):
+        try:
+            with open(os.path.join(self.path, f"slot-{slot}.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, slot, state):
+        path = os.path.join(self.path, f"slot-{slot}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+
+class RenderCache:
+    """Render Cache
+    Content addressed cache of renders shared by every run on the host.  A
+    SQLite index maps a render key to its report and the blobs it used (the DOM
+    and screenshot files), blobs are stored once per sha256 under blobs/.
+    Renders older than ttl are never returned and the least recently used are
+    evicted once the cache holds more than max_bytes.
+    """
+
+    def __init__(self, path, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.blobs = os.path.join(path, "blobs")
+        os.makedirs(self.blobs, exist_ok=True)
+
+        self.connection = sqlite3.connect(
+            os.path.join(path, "index.sqlite"), timeout=30
+        )
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS renders (key TEXT PRIMARY KEY, "
+                "created REAL NOT NULL, used REAL NOT NULL, size INTEGER NOT NULL, "
+                "value TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS render_blobs (key TEXT NOT NULL, "
+                "name TEXT NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (key, name))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs "
+                "(hash TEXT PRIMARY KEY, size INTEGER NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS counters "
+                "(name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    def key(self, *parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key, directory):
+        """Get
+        Cached report for key, with its DOM restored and its files linked into
+        directory.  Returns the report and the file paths, or None.
+        """
+        row = self.connection.execute(
+            "SELECT value FROM renders WHERE key = ? AND created >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        blobs = self.connection.execute(
+            "SELECT name, hash FROM render_blobs WHERE key = ?", (key,)
+        ).fetchall()
+
+        if row is None or not all(os.path.exists(self._blob(h)) for _, h in blobs):
+            self.misses += 1
+            self._count("misses")
+            return None
+
+        value = json.loads(row[0])
+        paths = list()
+        try:
+            for name, digest in blobs:
+                if name == "html":
+                    with open(self._blob(digest), encoding="utf-8") as f:
+                        value["html"] = f.read()
+                    continue
+                path = os.path.join(directory, name)
+                if os.path.exists(path):
+                    os.unlink(path)
+                link_or_copy(self._blob(digest), path)
+                paths.append(path)
+        except FileNotFoundError:
+            # evicted by another run since the lookup
+            self.misses += 1
+            self._count("misses")
+            return None
+
+        with self.connection:
+            self.connection.execute(
+                "UPDATE renders SET used = ? WHERE key = ?", (time.time(), key)
+            )
+        self.hits += 1
+        self._count("hits")
+        return value, paths
+
+    def put(self, key, value, paths):
+        value = dict(value)
+        with self.connection:
+            # claim the write lock before touching blobs so eviction in another
+            # run can't delete one this render is about to reference
+            self.connection.execute("DELETE FROM render_blobs WHERE key = ?", (key,))
+
+            blobs = list()
+            if value.get("html"):
+                blobs.append(("html", self._store_text(value.pop("html"))))
+            for path in paths:
+                blobs.append((os.path.basename(path), self._store_file(path)))
+
+            encoded = json.dumps(value)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO renders (key, created, used, size, value) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    time.time(),
+                    time.time(),
+                    len(encoded) + sum(size for _, (_, size) in blobs),
+                    encoded,
+                ),
+            )
+            for name, (digest, size) in blobs:
+                self.connection.execute(
+                    "INSERT INTO render_blobs (key, name, hash) VALUES (?, ?, ?)",
+                    (key, name, digest),
+                )
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO blobs (hash, size) VALUES (?, ?)",
+                    (digest, size),
+                )
+            self._evict()
+
+    def stats(self):
+        stats = {"hits": self.hits, "misses": self.misses}
+        for name, value in self.connection.execute("SELECT name, value FROM counters"):
+            stats["total_" + name] = value
+        renders, blob_bytes = self.connection.execute(
+            "SELECT (SELECT COUNT(*) FROM renders), "
+            "(SELECT COALESCE(SUM(size), 0) FROM blobs)"
+        ).fetchone()
+        stats["renders"] = renders
+        stats["blob_bytes"] = blob_bytes
+        return stats
+
+    def _evict(self):
+        self.connection.execute(
+            "DELETE FROM renders WHERE created < ?", (time.time() - self.ttl,)
+        )
+        # blobs shared by renders count against each, so this errs on the side
+        # of evicting early
+        self.connection.execute(
+            "DELETE FROM renders WHERE key IN (SELECT key FROM "
+            "(SELECT key, SUM(size) OVER (ORDER BY used DESC) AS total "
+            "FROM renders) WHERE total > ?)",
+            (self.max_bytes,),
+        )
+        self.connection.execute(
+            "DELETE FROM render_blobs WHERE key NOT IN (SELECT key FROM renders)"
+        )
+        orphans = self.connection.execute(
+            "SELECT hash FROM blobs WHERE hash NOT IN (SELECT hash FROM render_blobs)"
+        ).fetchall()
+        for (digest,) in orphans:
+            self.connection.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+            try:
+                os.unlink(self._blob(digest))
+            except FileNotFoundError:
+                pass
+
+    def _store_text(self, text):
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self._blob(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            with open(blob + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(blob + ".tmp", blob)
+        return digest, len(data)
+
+    def _store_file(self, path):
+        digest = file_sha256(path)
+        blob = self._blob(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if os.path.exists(blob + ".tmp"):
+                os.unlink(blob + ".tmp")
+            link_or_copy(path, blob + ".tmp")
+            os.replace(blob + ".tmp", blob)
+        return digest, os.path.getsize(blob)
+
+    def _blob(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def _count(self, name):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
 
 
 class HeadlessChromium(Analyzer):
@@ -27,12 +895,10 @@ class HeadlessChromium(Analyzer):
             "config.user_agent",
             "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:77.0) Gecko/20190101 Firefox/77.0",
         )
-        x = self.get_param("config.window_size_x", 1920)
-        y = self.get_param("config.window_size_y", 2160)
+        self.window_x = int(self.get_param("config.window_size_x", 1920))
+        self.window_y = int(self.get_param("config.window_size_y", 2160))
 
-        self.window_size = f"{x},{y}"
-
-        self.cwd = os.getcwd()
+        self.window_size = f"{self.window_x},{self.window_y}"
 
         self.data = self.get_data()
 
@@ -40,10 +906,112 @@ class HeadlessChromium(Analyzer):
         if self.service not in SERVICES:
             self.error("bad service")
 
-        self.filename = None
+        self.screenshots = list()
 
         self.proxies = self.get_param("config.proxy", None)
 
+        self.render_timeout = int(
+            self.get_param("config.render_timeout", DEFAULT_RENDER_TIMEOUT)
+        )
+
+        # screenshot output, anything but a single PNG is taken over DevTools
+        self.screenshot_format = self.get_param(
+            "config.screenshot_format", DEFAULT_SCREENSHOT_FORMAT
+        )
+        if self.screenshot_format not in SCREENSHOT_EXTENSIONS:
+            self.error("bad screenshot_format")
+        self.screenshot_quality = int(
+            self.get_param("config.screenshot_quality", DEFAULT_SCREENSHOT_QUALITY)
+        )
+        self.screenshot_full_page = self.get_param("config.screenshot_full_page", False)
+        self.screenshot_tile_height = int(
+            self.get_param("config.screenshot_tile_height", self.window_y)
+        )
+        self.thumbnail_width = int(
+            self.get_param("config.thumbnail_width", DEFAULT_THUMBNAIL_WIDTH)
+        )
+        self.thumbnail = self.get_param("config.screenshot_thumbnail", False)
+
+        # render cache is only used when a path is configured
+        self.cache = None
+        # analysts force a re-render per job, the config item is only a default
+        self.cache_bypass = self.get_param(
+            "parameters.cache_bypass", self.get_param("config.cache_bypass", False)
+        )
+        cache_path = self.get_param("config.cache_path", None)
+        if cache_path is not None:
+            cache_ttl = int(self.get_param("config.cache_ttl", DEFAULT_CACHE_TTL))
+            if cache_ttl < 1:
+                self.error("cache_ttl must be greater than 0")
+            self.cache = RenderCache(
+                cache_path,
+                cache_ttl,
+                int(self.get_param("config.cache_max_bytes", DEFAULT_CACHE_MAX_BYTES)),
+            )
+
+        # fast DOM mode, rendered over DevTools with resources blocked
+        self.fast_dom = self.get_param("config.fast_dom", False)
+        self.block_resource_types = self.get_param(
+            "config.block_resource_types", list(DEFAULT_BLOCK_RESOURCE_TYPES)
+        )
+        self.block_url_patterns = self.get_param("config.block_url_patterns", [])
+        self.dom_wait_until = self.get_param(
+            "config.dom_wait_until", DEFAULT_DOM_WAIT_UNTIL
+        )
+        if self.dom_wait_until not in LIFECYCLE_EVENTS:
+            self.error("bad dom_wait_until")
+        self.dom_wait_timeout = int(
+            self.get_param("config.dom_wait_timeout", DEFAULT_DOM_WAIT_TIMEOUT)
+        )
+
+        admission_timeout = int(
+            self.get_param("config.admission_timeout", DEFAULT_ADMISSION_TIMEOUT)
+        )
+        self.admission = Admission(
+            self.get_param(
+                "config.admission_path",
+                os.path.join(tempfile.gettempdir(), "headless-chromium-admission"),
+            ),
+            int(self.get_param("config.max_browsers", DEFAULT_MAX_BROWSERS)),
+            int(self.get_param("config.min_free_memory_mb", 0)),
+            admission_timeout,
+        )
+        self.queue_wait = 0.0
+        self.deadline = None
+
+        self.profiles = ProfileManager(
+            self.get_param(
+                "config.profile_path",
+                os.path.join(
+                    SHM_PATH if os.path.isdir(SHM_PATH) else tempfile.gettempdir(),
+                    "headless-chromium-profiles",
+                ),
+            ),
+            int(self.get_param("config.profile_pool_size", DEFAULT_PROFILE_POOL_SIZE)),
+            self.binary_path,
+        )
+
+        # long lived browsers are only used when a pool size is configured
+        self.pool = None
+        pool_size = int(self.get_param("config.pool_size", 0))
+        if pool_size > 0:
+            self.pool = BrowserPool(
+                self.get_param(
+                    "config.pool_path",
+                    os.path.join(tempfile.gettempdir(), "headless-chromium-pool"),
+                ),
+                pool_size,
+                self.binary_path,
+                int(self.get_param("config.pool_max_pages", DEFAULT_POOL_MAX_PAGES)),
+                int(
+                    self.get_param(
+                        "config.pool_max_memory_mb", DEFAULT_POOL_MAX_MEMORY_MB
+                    )
+                ),
+                self.render_timeout,
+                admission_timeout,
+            )
+
     def get_domain_from_url(self, url: str) -> str:
         domain = urlsplit(url).netloc
 
@@ -57,16 +1025,35 @@ class HeadlessChromium(Analyzer):
 
         return domain
 
+    def _site(self, url):
+        domain = self.get_domain_from_url(url).lower()
+        if domain.startswith("www."):
+            domain = domain[4:]
+        return domain
+
     def summary(self, raw):
+        if self.service == "capture":
+            # http to https and www. hops are routine, leaving the site is not
+            redirects = raw.get("redirects", [])
+            count = len(redirects)
+            level = "info"
+            if any(
+                self._site(redirect["location"]) != self._site(redirect["url"])
+                for redirect in redirects
+            ):
+                level = "suspicious"
+            return {
+                "taxonomies": [
+                    self.build_taxonomy(level, "HeadlessChromium", "Redirects", count)
+                ]
+            }
         return {}
 
     def artifacts(self, raw):
-        if self.filename:
-            return [
-                self.build_artifact("file", self.filename),
-            ]
+        if self.screenshots and self.service != "capture":
+            return [self.build_artifact("file", path) for path in self.screenshots]
         else:
-            artifacts = []
+            artifacts = [self.build_artifact("file", path) for path in self.screenshots]
             raw_str = str(raw)
             raw_str = raw_str.replace('\\"', '"')
             urls = set(iocextract.extract_urls(raw_str))
@@ -86,98 +1073,608 @@ class HeadlessChromium(Analyzer):
 
     def build_artifact(self, data_type, data, **kwargs):
         if data_type == "file":
-            (dst, filename) = tempfile.mkstemp(
-                dir=os.path.join(self.job_directory, "output")
+            output = os.path.join(self.job_directory, "output")
+            os.makedirs(output, exist_ok=True)
+            fd, filename = tempfile.mkstemp(
+                dir=output, suffix="-" + os.path.basename(data)
             )
-            with open(data, "rb") as src:
-                copyfileobj(src, open(dst, "wb"))
-                kwargs.update(
-                    {
-                        "dataType": data_type,
-                        "file": os.path.basename(filename),
-                        "filename": self.get_domain_from_url(self.data)
-                        + "-screenshot.png",
-                    }
-                )
-                return kwargs
+            os.close(fd)
+            try:
+                # screenshots are written in the job directory, a rename hands
+                # them over without copying
+                os.replace(data, filename)
+            except OSError:
+                shutil.copyfile(data, filename)
+                os.unlink(data)
+            kwargs.update(
+                {
+                    "dataType": data_type,
+                    "file": os.path.basename(filename),
+                    "filename": self.get_domain_from_url(self.data)
+                    + "-"
+                    + os.path.basename(data),
+                }
+            )
+            return kwargs
 
         else:
             kwargs.update({"dataType": data_type, "data": data})
             return kwargs
 
     def run(self):
-        letters = string.ascii_letters
-        tmp_profile_path = "/tmp/" + "".join(random.choice(letters) for i in range(13))
-        Path(tmp_profile_path).mkdir(exist_ok=True)
-
         url = self.data
+        started = time.monotonic()
+
+        cache_key = None
+        results = None
+        if self.cache is not None:
+            cache_key = self._cache_key(url)
+            if not self.cache_bypass:
+                cached = self.cache.get(cache_key, self.job_directory)
+                if cached is not None:
+                    # a hit never starts a browser
+                    results, self.screenshots = cached
+
+        if results is None:
+            results = self._render(url)
+            if cache_key is not None and (results.get("html") or self.screenshots):
+                self.cache.put(
+                    cache_key,
+                    {k: v for k, v in results.items() if k not in RUN_SECTIONS},
+                    self.screenshots,
+                )
 
+        if self.cache is not None:
+            results["cache"] = self.cache.stats()
+        results["timing"] = {
+            "queue_wait": round(self.queue_wait, 3),
+            "render": round(time.monotonic() - started - self.queue_wait, 3),
+        }
+        self.report(results)
+
+    def _cache_key(self, url):
+        options = {"proxy": self._get_proxy(url)}
+        if self.service in ("screenshot", "capture"):
+            options["screenshot"] = [
+                self.screenshot_format,
+                self.screenshot_quality,
+                self.screenshot_full_page,
+                self.screenshot_tile_height,
+                self.thumbnail,
+                self.thumbnail_width,
+            ]
+        if self._fast_dom():
+            options["fast_dom"] = [
+                self.block_resource_types,
+                self.block_url_patterns,
+                self.dom_wait_until,
+                self.dom_wait_timeout,
+            ]
+        return self.cache.key(
+            self.service,
+            normalize_url(url),
+            self.user_agent,
+            self.window_size,
+            options,
+        )
+
+    def _render(self, url):
+        try:
+            pool = None
+            if self.pool is not None:
+                try:
+                    results, pool = self._render_pool(url)
+                except DevToolsError as e:
+                    # fall back to a one off browser process
+                    pool = {"fallback": str(e)}
+
+            if pool is None or "fallback" in pool:
+                with self.admission.admit() as queue_wait:
+                    self._start_render(queue_wait)
+                    profile, hit = self.profiles.acquire(
+                        max(0, self.deadline - time.monotonic())
+                    )
+                    try:
+                        if self._use_devtools():
+                            results = self._render_browser(url, profile)
+                        else:
+                            results = self._render_subprocess(url, profile)
+                    finally:
+                        self.profiles.release(profile)
+                results["profile"] = self.profiles.metrics(hit)
+        except (AdmissionError, RenderTimeout) as e:
+            self.error(str(e))
+        except OSError as e:
+            # binary_path missing or not executable
+            self.error(f"Unable to start the browser: {e}")
+
+        if pool is not None:
+            results["pool"] = pool
+        return results
+
+    def _fast_dom(self):
+        return self.service == "dom" and self.fast_dom
+
+    def _use_devtools(self):
+        """Use DevTools
+        Whether a browser started for the job is driven over DevTools, the
+        --dump-dom and --screenshot switches only cover the plain DOM and a
+        viewport PNG.
+        """
+        if self.service == "capture" or self._fast_dom():
+            return True
+        return self.service == "screenshot" and (
+            self.screenshot_format != "png"
+            or self.screenshot_full_page
+            or self.thumbnail
+        )
+
+    def _start_render(self, queue_wait):
+        """Start Render
+        Count time spent waiting for a browser and start the render_timeout
+        wall clock for the browser about to be used.
+        """
+        self.queue_wait += queue_wait
+        self.deadline = time.monotonic() + self.render_timeout
+
+    def _render_pool(self, url):
+        """Render Pool
+        Render url in a new browser context of a pooled browser, the context is
+        disposed of afterwards.  Returns the service's results and pool stats.
+        """
+        waiting = time.monotonic()
+        slot, lock = self.pool.acquire()
+        self._start_render(time.monotonic() - waiting)
+        try:
+            devtools, state = self.pool.connect(slot)
+            devtools.deadline = self.deadline
+            try:
+                results = self._render_devtools(devtools, url)
+            except (DevToolsError, RenderTimeout):
+                # a browser that failed a page is not trusted with the next one
+                self.pool.recycle(slot, state)
+                raise
+            finally:
+                devtools.close()
+
+            rss, recycled = self.pool.finish(slot, state)
+            return results, {
+                "slot": slot,
+                "pages": state["pages"],
+                "rss_mb": round(rss / 1024 / 1024, 1),
+                "recycled": recycled,
+            }
+        finally:
+            self.pool.release(lock)
+
+    def _render_browser(self, url, profile):
+        """Render Browser
+        Render url over DevTools in a browser started for this job alone.
+        """
+        try:
+            process, ws_url = launch_browser(self.binary_path, profile)
+            try:
+                devtools = DevTools(ws_url, self.render_timeout, self.deadline)
+                try:
+                    return self._render_devtools(devtools, url)
+                finally:
+                    devtools.close()
+            finally:
+                kill_process_group(process.pid)
+                process.wait()
+        except DevToolsError as e:
+            self.error(f"Unable to render {url}: {e}")
+
+    def _render_devtools(self, devtools, url):
+        context_params = {"disposeOnDetach": True}
+        proxy = self._get_proxy(url)
+        if proxy is not None:
+            context_params["proxyServer"] = proxy
+        context_id = devtools.send("Target.createBrowserContext", context_params)[
+            "browserContextId"
+        ]
+
+        try:
+            target_id = devtools.send(
+                "Target.createTarget",
+                {"url": "about:blank", "browserContextId": context_id},
+            )["targetId"]
+            session_id = devtools.send(
+                "Target.attachToTarget", {"targetId": target_id, "flatten": True}
+            )["sessionId"]
+
+            devtools.send("Page.enable", session_id=session_id)
+            if self.service == "capture":
+                documents = self._record_documents(devtools, session_id)
+                devtools.send("Network.enable", session_id=session_id)
+            if self._fast_dom():
+                blocked = self._block_resources(devtools, session_id)
+                devtools.send(
+                    "Page.setLifecycleEventsEnabled",
+                    {"enabled": True},
+                    session_id=session_id,
+                )
+            devtools.send(
+                "Network.setUserAgentOverride",
+                {"userAgent": self.user_agent},
+                session_id=session_id,
+            )
+            devtools.send(
+                "Emulation.setDeviceMetricsOverride",
+                {
+                    "width": self.window_x,
+                    "height": self.window_y,
+                    "deviceScaleFactor": 1,
+                    "mobile": False,
+                },
+                session_id=session_id,
+            )
+
+            navigation = devtools.send(
+                "Page.navigate", {"url": url}, session_id=session_id
+            )
+            if navigation.get("errorText"):
+                return self._navigation_error(navigation["errorText"])
+
+            results = dict()
+            if self._fast_dom():
+                results["lifecycle"] = self._wait_lifecycle(
+                    devtools, session_id, navigation
+                )
+            else:
+                devtools.wait_for("Page.loadEventFired", session_id)
+                if self.service == "capture":
+                    self._wait_navigations(devtools, session_id, navigation["frameId"])
+
+            if self.service in ("screenshot", "capture"):
+                results.update(self._capture_screenshots(devtools, session_id))
+
+            if self.service in ("dom", "capture"):
+                results["html"] = devtools.send(
+                    "Runtime.evaluate",
+                    {
+                        "expression": "document.documentElement.outerHTML",
+                        "returnByValue": True,
+                    },
+                    session_id=session_id,
+                )["result"].get("value", "")
+                results["stderr"] = ""
+
+            if self.service == "capture":
+                results.update(
+                    self._redirect_chain(documents, navigation["frameId"], url)
+                )
+
+            if self._fast_dom():
+                results["blocked_count"] = len(blocked)
+                results["blocked"] = blocked[:MAX_BLOCKED_REPORTED]
+
+            return results
+        finally:
+            try:
+                devtools.send(
+                    "Target.disposeBrowserContext", {"browserContextId": context_id}
+                )
+            except (DevToolsError, RenderTimeout):
+                pass
+
+    def _capture_screenshots(self, devtools, session_id):
+        """Capture Screenshots
+        The viewport, or the full page split into tiles of screenshot_tile_height
+        pixels, plus an optional thumbnail of the viewport.
+        """
+        params = {"format": self.screenshot_format}
+        if self.screenshot_format != "png":
+            params["quality"] = self.screenshot_quality
+
+        def capture(name, **extra):
+            data = devtools.send(
+                "Page.captureScreenshot", {**params, **extra}, session_id=session_id
+            )["data"]
+            self._save_screenshot(name, base64.b64decode(data))
+
+        results = dict()
+        if self.screenshot_full_page:
+            metrics = devtools.send("Page.getLayoutMetrics", session_id=session_id)
+            size = metrics.get("cssContentSize", metrics.get("contentSize"))
+            width, height = int(size["width"]), int(size["height"])
+            tiles = range(0, height, self.screenshot_tile_height)
+            results["full_page"] = {
+                "width": width,
+                "height": height,
+                "tiles": len(tiles),
+                "truncated": len(tiles) > MAX_SCREENSHOT_TILES,
+            }
+            for n, y in enumerate(tiles[:MAX_SCREENSHOT_TILES], 1):
+                capture(
+                    f"tile-{n:02d}",
+                    clip={
+                        "x": 0,
+                        "y": y,
+                        "width": width,
+                        "height": min(self.screenshot_tile_height, height - y),
+                        "scale": 1,
+                    },
+                    captureBeyondViewport=True,
+                )
+        else:
+            capture("screenshot")
+
+        if self.thumbnail:
+            capture(
+                "thumbnail",
+                clip={
+                    "x": 0,
+                    "y": 0,
+                    "width": self.window_x,
+                    "height": self.window_y,
+                    "scale": self.thumbnail_width / self.window_x,
+                },
+            )
+
+        results["result"] = "created screenshot"
+        results["screenshots"] = self._screenshot_sizes()
+        return results
+
+    def _save_screenshot(self, name, data):
+        path = os.path.join(
+            self.job_directory,
+            f"{name}.{SCREENSHOT_EXTENSIONS[self.screenshot_format]}",
+        )
+        with open(path, "wb") as f:
+            f.write(data)
+        self.screenshots.append(path)
+
+    def _screenshot_sizes(self):
+        return [
+            {"name": os.path.basename(path), "bytes": os.path.getsize(path)}
+            for path in self.screenshots
+        ]
+
+    def _block_resources(self, devtools, session_id):
+        """Block Resources
+        Pause requests for the blocked resource types and URL patterns and fail
+        them as they arrive.  Returns the list the blocked requests are added to.
+        """
+        patterns = [
+            {"urlPattern": "*", "resourceType": resource_type}
+            for resource_type in self.block_resource_types
+        ]
+        patterns.extend({"urlPattern": pattern} for pattern in self.block_url_patterns)
+
+        blocked = list()
+        if not patterns:
+            return blocked
+
+        def block(event):
+            if event.get("sessionId") != session_id:
+                return
+            params = event["params"]
+            blocked.append(
+                {"url": params["request"]["url"], "type": params["resourceType"]}
+            )
+            devtools.post(
+                "Fetch.failRequest",
+                {"requestId": params["requestId"], "errorReason": "BlockedByClient"},
+                session_id=session_id,
+            )
+
+        devtools.on("Fetch.requestPaused", block)
+        devtools.send("Fetch.enable", {"patterns": patterns}, session_id=session_id)
+        return blocked
+
+    def _wait_lifecycle(self, devtools, session_id, navigation):
+        """Wait Lifecycle
+        Wait up to dom_wait_timeout seconds for the main frame to reach the
+        dom_wait_until lifecycle event, the DOM is taken either way.
+        """
+        try:
+            devtools.wait_for(
+                "Page.lifecycleEvent",
+                session_id,
+                timeout=self.dom_wait_timeout,
+                match=lambda params: params["name"] == self.dom_wait_until
+                and params["frameId"] == navigation["frameId"]
+                and params.get("loaderId") == navigation.get("loaderId"),
+            )
+            reached = True
+        except DevToolsTimeout:
+            reached = False
+        return {"event": self.dom_wait_until, "reached": reached}
+
+    def _record_documents(self, devtools, session_id):
+        """Record Documents
+        Collect document requests and responses as they arrive rather than from
+        the event buffer, returns the list they are added to in arrival order.
+        """
+        documents = list()
+
+        def record(event):
+            if (
+                event.get("sessionId") == session_id
+                and event["params"].get("type") == "Document"
+            ):
+                documents.append(event)
+
+        devtools.on("Network.requestWillBeSent", record)
+        devtools.on("Network.responseReceived", record)
+        return documents
+
+    def _wait_navigations(self, devtools, session_id, frame_id):
+        """Wait Navigations
+        After the load event keep the page open while the main frame navigates
+        again (meta refresh or script redirects), waiting CLIENT_REDIRECT_WAIT
+        seconds for each navigation and the load that follows it.  Stops after
+        MAX_CLIENT_REDIRECTS or before the render timeout would pass.
+        """
+        # navigations before the load event belong to the loaded page
+        devtools.drain("Page.frameNavigated", session_id)
+        for _ in range(MAX_CLIENT_REDIRECTS):
+            if (
+                devtools.deadline is not None
+                and time.monotonic() + CLIENT_REDIRECT_WAIT >= devtools.deadline
+            ):
+                return
+            try:
+                devtools.wait_for(
+                    "Page.frameNavigated",
+                    session_id,
+                    timeout=CLIENT_REDIRECT_WAIT,
+                    match=lambda params: params["frame"]["id"] == frame_id,
+                )
+                devtools.wait_for(
+                    "Page.loadEventFired", session_id, timeout=CLIENT_REDIRECT_WAIT
+                )
+            except DevToolsTimeout:
+                return
+
+    def _redirect_chain(self, documents, frame_id, url):
+        """Redirect Chain
+        Main frame document requests seen while loading the page.  HTTP redirects
+        arrive as a request carrying the redirect response, script or meta
+        refresh navigations as a new document request.  Returns the hops, the
+        final URL and its status code.
+        """
+        documents = [
+            event for event in documents if event["params"].get("frameId") == frame_id
+        ]
+
+        statuses = dict()
+        for event in documents:
+            if event["method"] == "Network.responseReceived":
+                params = event["params"]
+                statuses[params["requestId"]] = params["response"]["status"]
+
+        redirects = list()
+        final_url = url
+        request_id = None
+        for event in documents:
+            if event["method"] != "Network.requestWillBeSent":
+                continue
+            params = event["params"]
+
+            response = params.get("redirectResponse")
+            if response is not None:
+                redirects.append(
+                    {
+                        "url": response["url"],
+                        "status_code": response["status"],
+                        "location": params["request"]["url"],
+                        "type": "http",
+                    }
+                )
+            elif request_id is not None:
+                redirects.append(
+                    {
+                        "url": final_url,
+                        "status_code": statuses.get(request_id),
+                        "location": params["request"]["url"],
+                        "type": "client",
+                    }
+                )
+            final_url = params["request"]["url"]
+            request_id = params["requestId"]
+
+        return {
+            "redirects": redirects,
+            "final_url": final_url,
+            "status_code": statuses.get(request_id),
+        }
+
+    def _navigation_error(self, error_text):
+        if self.service in ("screenshot", "capture"):
+            self.error("Missing screenshot. " + error_text)
+        return {"html": "", "stderr": error_text}
+
+    def _render_subprocess(self, url, profile):
         if self.service == "screenshot":
 
-            filename = os.path.join(self.cwd, "screenshot.png")
+            filename = os.path.join(self.job_directory, "screenshot.png")
             if os.path.exists(filename):
-                Path(filename).unlink()
+                os.unlink(filename)
 
             command_parts = [
                 self.binary_path,
                 "--headless",
-                "--user-data-dir=" + tmp_profile_path,
+                "--user-data-dir=" + profile,
                 "--window-size=" + self.window_size,
-                f'--user-agent="{self.user_agent}"',
-                "--screenshot",
+                "--user-agent=" + self.user_agent,
             ]
 
             proxy = self._get_proxy_args(url)
             if proxy is not None:
                 command_parts.append(proxy)
 
-            command_parts.append(["--screenshot", url])
+            command_parts.extend(["--screenshot=" + filename, url])
 
-            completed_process = subprocess.run(
-                command_parts,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                encoding="utf-8",
-            )
+            _, stderr = self._run_browser(command_parts)
 
             if not os.path.exists(filename):
-                self.error("Missing screenshot. " + completed_process.stderr)
+                self.error("Missing screenshot. " + stderr)
             else:
-                self.filename = filename
-                self.report({"result": "created screenshot"})
+                self.screenshots.append(filename)
+                return {
+                    "result": "created screenshot",
+                    "screenshots": self._screenshot_sizes(),
+                }
         elif self.service == "dom":
             command_parts = [
                 self.binary_path,
                 "--headless",
-                "--user-data-dir=" + tmp_profile_path,
-                f'--user-agent="{self.user_agent}"',
+                "--user-data-dir=" + profile,
+                "--user-agent=" + self.user_agent,
             ]
 
             proxy = self._get_proxy_args(url)
             if proxy is not None:
                 command_parts.append(proxy)
 
-            command_parts.append(["--dump-dom", url])
+            command_parts.extend(["--dump-dom", url])
 
-            completed_process = subprocess.run(
-                command_parts,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                encoding="UTF-8",
-            )
+            stdout, stderr = self._run_browser(command_parts)
 
-            self.report(
-                {"html": completed_process.stdout, "stderr": completed_process.stderr,}
-            )
+            return {
+                "html": stdout,
+                "stderr": stderr,
+            }
 
-    def _get_proxy_args(self, url):
+    def _run_browser(self, command_parts):
+        """Run Browser
+        Run a one off browser in its own process group, the whole group is
+        killed once it exits or render_timeout passes.  Returns stdout and
+        stderr.
+        """
+        process = subprocess.Popen(
+            command_parts,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8",
+            start_new_session=True,
+        )
+        try:
+            return process.communicate(timeout=max(0, self.deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            raise RenderTimeout(f"Browser killed after {self.render_timeout} seconds")
+        finally:
+            # renderers and helpers can outlive the browser process
+            kill_process_group(process.pid)
+            if process.returncode is None:
+                process.communicate()
+
+    def _get_proxy(self, url):
         if self.proxies:
             if url.startswith("https"):
                 if "https" in self.proxies:
-                    return "--proxy_server=" + self.proxies["https"]
+                    return self.proxies["https"]
             elif url.startswith("http"):
                 if "http" in self.proxies:
-                    return "--proxy_server=" + self.proxies["http"]
+                    return self.proxies["http"]
+        return None
+
+    def _get_proxy_args(self, url):
+        proxy = self._get_proxy(url)
+        if proxy is not None:
+            return "--proxy-server=" + proxy
         return None
 
 
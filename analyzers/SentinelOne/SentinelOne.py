@@ -1,30 +1,398 @@
 #!/usr/bin/env python3
 
+import codecs
+import fcntl
+import hashlib
+import json
+import os
+import random
 import re
+import sqlite3
+import tempfile
 import time
-from datetime import datetime, timedelta
-from typing import Any, Dict, Iterator, Match, Pattern, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+    Union,
+)
 from urllib.parse import urlsplit
 
 import requests
 from cortexutils.analyzer import Analyzer
 
-AGENT_NAME_RE: Pattern = re.compile(r'"agentName":"([^"]+)"')
+BATCH_SEPARATORS: Pattern = re.compile(r"[\n,]")
 DATETIME_FORMAT: str = "%Y-%m-%dT%H:%M:%S.%fZ"
+DEFAULT_CACHE_MAX_BYTES: int = 50 * 1024 * 1024
+DEFAULT_CACHE_TTL: int = 300
 DEFAULT_CHECK_QUERY_SECONDS: int = 5
 DEFAULT_EVENT_COUNT: int = 200
+DEFAULT_FIRST_CHECK_SECONDS: float = 0.5
+DEFAULT_QUERY_TIMEOUT_SECONDS: int = 600
 DEFAULT_HOURS_AGO: int = 2
-NEXT_CURSOR_NONE: str = '"nextCursor":null,'
-NEXT_CURSOR_RE: Pattern = re.compile(r'"nextCursor":"([^"]+)"')
+DEFAULT_MAX_QUERY_LENGTH: int = 10000
+DEFAULT_MAX_RETRIES: int = 3
+DEFAULT_RATE_LIMIT: float = 5.0
+DEFAULT_RATE_LIMIT_BURST: int = 10
+DEFAULT_RETRY_SECONDS: float = 1.0
+MAX_RETRY_SECONDS: float = 60.0
+RETRY_STATUS_CODES: Tuple[int, ...] = (429, 502, 503, 504)
+DEFAULT_SLICES: int = 1
+DEFAULT_WORKERS: int = 4
+EVENT_FIELDS: Tuple[str, ...] = ("agentName", "DNSRequest")
+EVENTS_CHUNK_SIZE: int = 64 * 1024
 S1_API_ENDPOINTS: Dict[str, str] = {
     "create-query-and-get-id": "/web/api/v2.1/dv/init-query",
     "check-query-status": "/web/api/v2.1/dv/query-status",
     "get-events": "/web/api/v2.1/dv/events",
+    "cancel-query": "/web/api/v2.1/dv/cancel-query",
 }
-SERVICES: Tuple[str] = ("dns-lookups",)
+DNS_QUERY: str = 'EventType = "DNS Resolved" AND {}'
+DNS_REQUEST_CONDITION: str = 'DNSRequest contains "{}"'
+SERVICES: Tuple[str, ...] = ("dns-lookups", "dns-lookups-batch")
 USER_AGENT: str = "Cortex/SentinelOne-Analyzer-v1.0"
 
 
+class DomainTrie:
+    """Domain Trie
+    Domain names indexed by their labels in reverse ("www.evil.com" is stored
+    under com -> evil -> www), so a domain and all of its subdomains sit under one
+    node.  Each indexed name carries an agent set and event count.
+    """
+
+    def __init__(self):
+        self.root = dict()
+        self.names = dict()
+
+    def add(self, name: str, agents: Set[str], events: int) -> None:
+        name = name.lower().rstrip(".")
+        if not name:
+            return
+
+        if name not in self.names:
+            node = self.root
+            for label in reversed(name.split(".")):
+                node = node.setdefault(label, dict())
+            node[None] = name
+            self.names[name] = {"agents": set(), "events": 0}
+
+        self.names[name]["agents"].update(agents)
+        self.names[name]["events"] += events
+
+    def under(self, domain: str) -> Iterator[str]:
+        """Under
+        Yields indexed names that are domain or one of its subdomains.
+        """
+        node = self.root
+        for label in reversed(domain.lower().rstrip(".").split(".")):
+            node = node.get(label)
+            if node is None:
+                return
+
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for label, child in node.items():
+                if label is None:
+                    yield child
+                else:
+                    nodes.append(child)
+
+    def breakdown(self, domain: str) -> List[Dict[str, Any]]:
+        """Breakdown
+        Every indexed name matching domain as DNSRequest contains would, with its
+        agents, event count and whether it is an exact, subdomain or substring
+        match.  Sorted by match type then name.
+        """
+        domain = domain.lower().rstrip(".")
+        matches = dict()
+        for name in self.under(domain):
+            matches[name] = "exact" if name == domain else "subdomain"
+        for name in self.names:
+            if name not in matches and domain in name:
+                matches[name] = "substring"
+
+        order = {"exact": 0, "subdomain": 1, "substring": 2}
+        return [
+            {
+                "domain": name,
+                "match": match,
+                "agent_names": sorted(self.names[name]["agents"]),
+                "events": self.names[name]["events"],
+            }
+            for name, match in sorted(
+                matches.items(), key=lambda x: (order[x[1]], x[0])
+            )
+        ]
+
+
+class EventStream:
+    """Event Stream
+    Incremental parser for get-events response bodies.  The body is read in chunks
+    and each element of the "data" array is decoded on its own as soon as it is
+    complete, so memory holds one event and one chunk rather than the whole page.
+    Other top level members (e.g. "pagination") are kept in fields once the
+    events have been read.
+    """
+
+    WHITESPACE: str = " \t\n\r"
+    NUMBER_CHARS: str = "0123456789.eE+-"
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.exhausted = False
+        self.fields = dict()
+
+    def events(self) -> Iterator[Dict[str, Any]]:
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "data" and self._peek() == "[":
+                self.pos += 1
+                if self._peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.fields[key] = self._value()
+
+            if self._expect(",}") == "}":
+                return
+
+    def _fill(self) -> bool:
+        if self.exhausted:
+            return False
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            text = self.text_decoder.decode(b"", final=True)
+        else:
+            text = self.text_decoder.decode(chunk)
+
+        self.buffer = self.buffer[self.pos :] + text
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer):
+                if self.buffer[self.pos] not in self.WHITESPACE:
+                    return self.buffer[self.pos]
+                self.pos += 1
+            if not self._fill():
+                raise ValueError("Unexpected end of events response")
+
+    def _expect(self, expected: str) -> str:
+        char = self._peek()
+        if char not in expected:
+            raise ValueError(
+                f"Expected {' or '.join(expected)} at {self.pos} in events response, "
+                f"found {char}"
+            )
+        self.pos += 1
+        return char
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # incomplete value, read on unless there is nothing left
+                if not self._fill():
+                    raise
+                continue
+
+            # a number followed only by characters that can still belong to it
+            # ("1." or "1e" at a chunk boundary) may continue in the next chunk
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                tail = end
+                while (
+                    tail < len(self.buffer) and self.buffer[tail] in self.NUMBER_CHARS
+                ):
+                    tail += 1
+                if tail == len(self.buffer) and self._fill():
+                    continue
+
+            self.pos = end
+            return value
+
+
+class RateLimiter:
+    """Rate Limiter
+    Token bucket shared by every process on the host through a lock file holding
+    the bucket state.  Tokens refill at rate per second up to burst, acquire
+    blocks until one is available.  block() holds every process off the API until
+    a time, e.g. from a 429 Retry-After.
+    """
+
+    def __init__(self, path: str, rate: float, burst: int):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def acquire(self) -> float:
+        """Acquire
+        Take a token, returns seconds spent waiting for it.
+        """
+        waited = 0.0
+        while True:
+            with self._state() as state:
+                now = time.time()
+                if state["blocked_until"] > now:
+                    wait = state["blocked_until"] - now
+                elif state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    return waited
+                else:
+                    wait = (1 - state["tokens"]) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def block(self, seconds: float) -> None:
+        with self._state() as state:
+            state["blocked_until"] = max(state["blocked_until"], time.time() + seconds)
+
+    @contextmanager
+    def _state(self) -> Iterator[Dict[str, float]]:
+        """State
+        Bucket state, refilled to now, with the lock file held.  Changes are
+        written back on exit.  A file object per use so threads of one process
+        exclude each other too.
+        """
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read())
+            except ValueError:
+                state = {
+                    "tokens": float(self.burst),
+                    "updated": 0.0,
+                    "blocked_until": 0.0,
+                }
+
+            now = time.time()
+            state["tokens"] = min(
+                float(self.burst),
+                state["tokens"] + max(0.0, now - state["updated"]) * self.rate,
+            )
+            state["updated"] = now
+            try:
+                yield state
+            finally:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+
+
+class ResultCache:
+    """Result Cache
+    SQLite backed cache of analyzer results shared by every run on the host.  Keys
+    include a time bucket of ttl seconds, entries older than ttl are never returned
+    and the oldest entries are evicted once stored results exceed max_bytes.
+    """
+
+    def __init__(self, path: str, ttl: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, created REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS counters "
+                "(name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    def key(self, *parts: Any) -> str:
+        bucket = int(time.time() // self.ttl)
+        return hashlib.sha256(
+            json.dumps([bucket] + list(parts), sort_keys=True).encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self.connection.execute(
+            "SELECT value FROM results WHERE key = ? AND created >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            self._count("misses")
+            return None
+
+        self.hits += 1
+        self._count("hits")
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results (key, created, value) VALUES (?, ?, ?)",
+                (key, time.time(), json.dumps(value)),
+            )
+            self.connection.execute(
+                "DELETE FROM results WHERE created < ?", (time.time() - self.ttl,)
+            )
+            self.connection.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM "
+                "(SELECT key, SUM(LENGTH(value)) OVER (ORDER BY created DESC) AS size "
+                "FROM results) WHERE size > ?)",
+                (self.max_bytes,),
+            )
+
+    def stats(self) -> Dict[str, int]:
+        stats = {"hits": self.hits, "misses": self.misses}
+        for name, value in self.connection.execute("SELECT name, value FROM counters"):
+            stats["total_" + name] = value
+        return stats
+
+    def _count(self, name: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
+
+
 class SentinelOne(Analyzer):
     def __init__(self):
         Analyzer.__init__(self)
@@ -50,6 +418,16 @@ class SentinelOne(Analyzer):
         if self.hours_ago < 1:
             self.error("hours_ago must be greater than 0")
 
+        self.slices = int(self.get_param("config.s1_slices", DEFAULT_SLICES))
+        if self.slices < 1:
+            self.error("s1_slices must be greater than 0")
+        self.workers = int(self.get_param("config.s1_workers", DEFAULT_WORKERS))
+        if self.workers < 1:
+            self.error("s1_workers must be greater than 0")
+        self.max_query_length = int(
+            self.get_param("config.s1_max_query_length", DEFAULT_MAX_QUERY_LENGTH)
+        )
+
         self.headers = {
             "Authorization": "ApiToken " + self.s1_api_key,
             "User-Agent": USER_AGENT,
@@ -61,50 +439,101 @@ class SentinelOne(Analyzer):
             self.error("bad service")
 
         self.s1_check_query_seconds = DEFAULT_CHECK_QUERY_SECONDS
+        self.s1_first_check_seconds = DEFAULT_FIRST_CHECK_SECONDS
+        self.s1_query_timeout = int(
+            self.get_param("config.s1_query_timeout", DEFAULT_QUERY_TIMEOUT_SECONDS)
+        )
+        if self.s1_query_timeout < 1:
+            self.error("s1_query_timeout must be greater than 0")
         self.s1_query_item_count = DEFAULT_EVENT_COUNT
+        self.s1_events_chunk_size = EVENTS_CHUNK_SIZE
         self.s1_api_endpoints = S1_API_ENDPOINTS
         self.s1_datetime_format = DATETIME_FORMAT
 
         self.proxies = self.get_param("config.proxy", None)
 
-    def _check_query_status(self, query_id: str) -> Tuple[bool, bool]:
-        response = requests.get(
-            self.s1_console_url + self.s1_api_endpoints["check-query-status"],
-            headers=self.headers,
-            params={"queryId": query_id},
-            proxies=self.proxies,
+        # API calls from every process on the host share one rate limit per console
+        self.max_retries = int(
+            self.get_param("config.s1_max_retries", DEFAULT_MAX_RETRIES)
         )
+        self.rate_limiter = None
+        rate_limit = float(self.get_param("config.s1_rate_limit", DEFAULT_RATE_LIMIT))
+        if rate_limit > 0:
+            self.rate_limiter = RateLimiter(
+                self.get_param(
+                    "config.s1_rate_limit_path",
+                    os.path.join(
+                        tempfile.gettempdir(),
+                        "sentinelone-"
+                        + hashlib.sha256(self.s1_console_url.encode()).hexdigest()[:16]
+                        + ".ratelimit",
+                    ),
+                ),
+                rate_limit,
+                int(
+                    self.get_param(
+                        "config.s1_rate_limit_burst", DEFAULT_RATE_LIMIT_BURST
+                    )
+                ),
+            )
+
+        # result cache is only used when a path is configured
+        self.cache = None
+        self.cache_bypass = self.get_param("config.cache_bypass", False)
+        cache_path = self.get_param("config.cache_path", None)
+        if cache_path is not None:
+            cache_ttl = int(self.get_param("config.cache_ttl", DEFAULT_CACHE_TTL))
+            if cache_ttl < 1:
+                self.error("cache_ttl must be greater than 0")
+            self.cache = ResultCache(
+                cache_path,
+                cache_ttl,
+                int(self.get_param("config.cache_max_bytes", DEFAULT_CACHE_MAX_BYTES)),
+            )
+
+    def _cancel_query(self, query_id: str) -> None:
+        """Cancel Query
+        Best effort, a query that cannot be cancelled times out on the console.
+        """
+        try:
+            self._request("POST", "cancel-query", json={"queryId": query_id})
+        except requests.RequestException:
+            pass
+
+    def _check_query_status(self, query_id: str) -> Tuple[bool, bool, Optional[int]]:
         """Check Query Status
-        Returns tuple of done, error
+        Returns tuple of done, error, progress status (percent, if sent)
         """
+        response = self._request(
+            "GET", "check-query-status", params={"queryId": query_id}
+        )
         if response.status_code == requests.codes.ok:
             data = response.json()
+            progress = data["data"].get("progressStatus")
             if data["data"]["responseState"] == "RUNNING":
-                return False, False
+                return False, False, progress
             elif data["data"]["responseState"] == "FINISHED":
-                return True, False
+                return True, False, progress
             else:
                 self.error(data["data"]["responseState"])
         else:
             self.error(self.errors_to_string(response))
 
-    def _create_query_and_get_id(self, query: str) -> Union[str, None]:
+    def _create_query_and_get_id(
+        self, query: str, from_date: datetime, to_date: datetime
+    ) -> Union[str, None]:
         """Create Query and Get ID
         """
-        to_date = datetime.utcnow()
-        response = requests.post(
-            self.s1_console_url + self.s1_api_endpoints["create-query-and-get-id"],
-            headers=self.headers,
+        response = self._request(
+            "POST",
+            "create-query-and-get-id",
             json={
-                "fromDate": self.get_from_date(to_date).strftime(
-                    self.s1_datetime_format
-                ),
+                "fromDate": from_date.strftime(self.s1_datetime_format),
                 "toDate": to_date.strftime(self.s1_datetime_format),
                 "query": query,
                 "accountIds": [self.s1_account_id,],
                 "queryType": ["events",],
             },
-            proxies=self.proxies,
         )
         if response.status_code == requests.codes.ok:
             data = response.json()
@@ -112,56 +541,285 @@ class SentinelOne(Analyzer):
         else:
             self.error(self.errors_to_string(response))
 
-    def agent_name_generator(
+    def _query_dns_requests(
+        self, query: str, from_date: datetime, to_date: datetime
+    ) -> Tuple[Optional[Dict[str, Dict[str, Any]]], Dict[str, Any]]:
+        """Query DNS Requests
+        Create a query for one window, wait for it and drain its events.  Events are
+        folded into one entry per distinct DNSRequest as they stream in, so memory
+        grows with distinct domains rather than events.  Returns
+        {dns_request: {"agents": set of agent names, "events": count}} (None if the
+        query errored) and query metrics.
+        """
+        started = time.monotonic()
+        query_id = self._create_query_and_get_id(query, from_date, to_date)
+
+        # wait for query to finish
+        metrics = self._wait_for_query(query_id, started)
+        errored = metrics.pop("errored")
+        if errored:
+            return None, metrics
+
+        metrics["time_to_first_result_seconds"] = None
+        dns_requests = dict()
+        for event in self.event_generator(query_id):
+            agent_name = event.get("agentName")
+            if agent_name is None:
+                continue
+            if metrics["time_to_first_result_seconds"] is None:
+                metrics["time_to_first_result_seconds"] = round(
+                    time.monotonic() - started, 3
+                )
+            seen = dns_requests.setdefault(
+                event.get("DNSRequest", ""), {"agents": set(), "events": 0}
+            )
+            seen["agents"].add(agent_name)
+            seen["events"] += 1
+
+        metrics["total_seconds"] = round(time.monotonic() - started, 3)
+        return dns_requests, metrics
+
+    def _run_queries(
+        self, queries: List[str], to_date: datetime
+    ) -> Tuple[
+        Optional[Dict[str, Dict[str, Any]]], Dict[str, Any], List[Dict[str, Any]]
+    ]:
+        """Run Queries
+        Run every query over the hours_ago window.  With s1_slices the window is
+        split into equal windows, newest first, and each query runs once per
+        window.  More than one query/window runs with up to s1_workers threads and
+        results are merged as each finishes, so the overall time is close to that
+        of the slowest query rather than the sum.  Returns the merged DNS requests
+        (None if every query errored), overall metrics and per query/window metrics.
+        """
+        started = time.monotonic()
+        width = timedelta(hours=self.hours_ago) / self.slices
+        tasks = [
+            (index, query, to_date - width * (i + 1), to_date - width * i)
+            for index, query in enumerate(queries)
+            for i in range(self.slices)
+        ]
+
+        if len(tasks) == 1:
+            return self._query_dns_requests(*tasks[0][1:]) + ([],)
+
+        task_metrics = [
+            {
+                "from": from_date.strftime(self.s1_datetime_format),
+                "to": window_to.strftime(self.s1_datetime_format),
+                "status": "running",
+            }
+            for _, _, from_date, window_to in tasks
+        ]
+        if len(queries) > 1:
+            for (index, _, _, _), task in zip(tasks, task_metrics):
+                task["batch"] = index
+
+        dns_requests = None
+        metrics = {"polls": 0, "time_to_first_result_seconds": None}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self._query_dns_requests, *task[1:]): index
+                for index, task in enumerate(tasks)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                task_dns_requests, query_metrics = future.result()
+                task_metrics[index].update(query_metrics)
+                metrics["polls"] += query_metrics["polls"]
+
+                if task_dns_requests is None:
+                    task_metrics[index]["status"] = "errored"
+                    continue
+
+                task_metrics[index]["status"] = "done"
+                if dns_requests is None:
+                    dns_requests = dict()
+                for dns_request, seen in task_dns_requests.items():
+                    merged = dns_requests.setdefault(
+                        dns_request, {"agents": set(), "events": 0}
+                    )
+                    merged["agents"].update(seen["agents"])
+                    merged["events"] += seen["events"]
+
+                if (
+                    task_dns_requests
+                    and metrics["time_to_first_result_seconds"] is None
+                ):
+                    metrics["time_to_first_result_seconds"] = round(
+                        time.monotonic() - started, 3
+                    )
+
+        metrics["total_seconds"] = round(time.monotonic() - started, 3)
+        return dns_requests, metrics, task_metrics
+
+    def _request(self, method: str, endpoint: str, **kwargs: Any) -> requests.Response:
+        """Request
+        Call an S1_API_ENDPOINTS endpoint once the shared rate limiter allows it.
+        429 and 5xx gateway responses are retried up to s1_max_retries times,
+        waiting for Retry-After if sent (other processes wait too) or backing off
+        exponentially with jitter.  The last response is returned either way.
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            response = requests.request(
+                method,
+                self.s1_console_url + self.s1_api_endpoints[endpoint],
+                headers=self.headers,
+                proxies=self.proxies,
+                **kwargs,
+            )
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt == self.max_retries
+            ):
+                return response
+
+            delay = self._retry_after(response)
+            if delay is None:
+                delay = random.uniform(0, DEFAULT_RETRY_SECONDS * 2**attempt)
+            else:
+                delay = min(delay, MAX_RETRY_SECONDS)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.block(delay)
+            response.close()
+            time.sleep(delay)
+
+    def _retry_after(self, response: requests.Response) -> Optional[float]:
+        """Retry After
+        Seconds to wait from a Retry-After header (seconds or HTTP date), None if
+        missing or unreadable.
+        """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(
+                0.0,
+                (
+                    parsedate_to_datetime(value) - datetime.now(timezone.utc)
+                ).total_seconds(),
+            )
+        except (TypeError, ValueError):
+            return None
+
+    def _wait_for_query(self, query_id: str, started: float) -> Dict[str, Any]:
+        """Wait for Query
+        Poll query status, first after s1_first_check_seconds then backing off
+        exponentially with jitter up to s1_check_query_seconds between checks.
+        Cancels the query and errors if it is not done s1_query_timeout seconds
+        after started (time.monotonic()).  Returns poll metrics for the report.
+        """
+        deadline = started + self.s1_query_timeout
+        delay = self.s1_first_check_seconds
+        metrics = {"polls": 0, "progress_status": None, "errored": False}
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._cancel_query(query_id)
+                self.error(
+                    f"Query {query_id} not finished after {self.s1_query_timeout} "
+                    f"seconds, progress {metrics['progress_status']}%"
+                )
+
+            if metrics["polls"] == 0:
+                time.sleep(min(remaining, delay))
+            else:
+                time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+
+            done, errored, progress = self._check_query_status(query_id)
+            metrics["polls"] += 1
+            if progress is not None:
+                metrics["progress_status"] = progress
+
+            if done or errored:
+                metrics["errored"] = errored
+                break
+
+            delay = min(delay * 2, self.s1_check_query_seconds)
+
+        metrics["time_to_finished_seconds"] = round(time.monotonic() - started, 3)
+        return metrics
+
+    def event_generator(
         self, query_id: str, next_cursor: str = None
-    ) -> Iterator[Match[Any]]:
-        """Agent Name Generator
-        Response may be massive, this will make multiple calls of 200 records at a time.
-        Each time looking for "AgentName" values as well as the "NextCursor".  This
-        would be simple if SentinelOne's API for Deep Visibility let you either GROUP
-        BY or pull a specified list of fields.
+    ) -> Iterator[Dict[str, Any]]:
+        """Event Generator
+        Response may be massive, this will make multiple calls of 200 records at a
+        time following "nextCursor".  Each page is parsed as it streams in (see
+        EventStream) and only the EVENT_FIELDS of each event are kept.  This would be
+        simpler if SentinelOne's API for Deep Visibility let you either GROUP BY or
+        pull a specified list of fields.
         """
 
-        done, errored = False, False
         params = {"queryId": query_id, "limit": self.s1_query_item_count}
-        while not (done or errored):
+        while True:
             if next_cursor:
                 params["nextCursor"] = next_cursor
 
-            response = requests.get(
-                self.s1_console_url + self.s1_api_endpoints["get-events"],
-                headers=self.headers,
-                params=params,
-                proxies=self.proxies,
-            )
+            response = self._request("GET", "get-events", params=params, stream=True)
 
             if response.status_code != requests.codes.ok:
                 self.error(self.errors_to_string(response))
-            else:
-                data = response.text
 
-                # if nextCursor is null, this is the end of the data
-                if NEXT_CURSOR_NONE in data:
-                    done = True
-                else:
-                    # get the next_cursor
-                    match_obj = NEXT_CURSOR_RE.search(data)
-                    if match_obj is not None:
-                        next_cursor = match_obj.group(1)
-                    else:
-                        errored = True
-
-                # find all agent names
-                for m in AGENT_NAME_RE.finditer(data):
-                    yield m[1]
+            try:
+                stream = EventStream(
+                    response.iter_content(chunk_size=self.s1_events_chunk_size)
+                )
+                for event in stream.events():
+                    yield {
+                        field: event[field] for field in EVENT_FIELDS if field in event
+                    }
+            except ValueError as e:
+                self.error(f"Unable to parse events response: {e}")
+            finally:
+                response.close()
+
+            # if nextCursor is null, this is the end of the data
+            next_cursor = (stream.fields.get("pagination") or {}).get("nextCursor")
+            if not next_cursor:
+                break
 
     def artifacts(self, raw):
-        if self.service == "dns-lookups":
+        if self.service in ("dns-lookups", "dns-lookups-batch"):
             return [
                 {"dataType": "host", "data": agent_name}
                 for agent_name in raw.get("agent_names", [])
             ]
 
+    def batch_queries(self, domains: List[str]) -> List[Tuple[str, List[str]]]:
+        """Batch Queries
+        Pack DNSRequest conditions for domains into as few queries as
+        s1_max_query_length allows, conditions are ORed.  Returns a list of query,
+        domains in query.  A domain too long to share a query gets its own.
+        """
+        batches = list()
+        conditions, batch_domains = list(), list()
+        for domain in domains:
+            condition = DNS_REQUEST_CONDITION.format(domain)
+            query = DNS_QUERY.format("(" + " OR ".join(conditions + [condition]) + ")")
+            if conditions and len(query) > self.max_query_length:
+                batches.append((conditions, batch_domains))
+                conditions, batch_domains = list(), list()
+            conditions.append(condition)
+            batch_domains.append(domain)
+        if conditions:
+            batches.append((conditions, batch_domains))
+
+        return [
+            (DNS_QUERY.format("(" + " OR ".join(conditions) + ")"), batch_domains)
+            for conditions, batch_domains in batches
+        ]
+
     def errors_to_string(self, response: requests.Response) -> str:
         """Errors to String
         Pull error(s) from JSON response if exists in response.  Return them as a single string.
@@ -174,12 +832,6 @@ class SentinelOne(Analyzer):
         except ValueError:
             return f"Recived {response.status_code} from SentinelOne."
 
-    def get_from_date(self, to_date: datetime) -> datetime:
-        """Get FromDate
-        Calculate FromDate from to_date - hours_ago
-        """
-        return to_date - timedelta(hours=self.hours_ago)
-
     def get_domain_from_url(self, url: str) -> str:
         domain = urlsplit(url).netloc
 
@@ -194,47 +846,120 @@ class SentinelOne(Analyzer):
         return domain
 
     def run(self):
-        if self.service == "dns-lookups":
-            if self.data_type not in ("domain", "fqdn", "url"):
+        if self.service in ("dns-lookups", "dns-lookups-batch"):
+            data_types = ("domain", "fqdn", "url")
+            if self.service == "dns-lookups-batch":
+                data_types += ("other",)
+            if self.data_type not in data_types:
                 self.not_supported()
 
             data = self.get_data()
-            if self.data_type == "url":
-                data = self.get_domain_from_url(data)
-
-            # create query and get query ID
-            query_id = self._create_query_and_get_id(
-                f'EventType = "DNS Resolved" AND DNSRequest contains "{data}"'
-            )
-            if query_id is not None:
-
-                # wait for query to finish
-                done, errored = False, False
-                while not (done or errored):
-                    time.sleep(self.s1_check_query_seconds)
-                    done, errored = self._check_query_status(query_id)
-
-                if not errored:
-                    agent_names = set()
-                    for agent_name in self.agent_name_generator(query_id):
-                        agent_names.add(agent_name)
-                    if agent_names:
-                        data = list(agent_names)
-                        data.sort()
-                    else:
-                        data = []
-                    self.report({"agent_names": data})
+            if self.service == "dns-lookups-batch":
+                observables = [x.strip() for x in BATCH_SEPARATORS.split(data)]
+                observables = [x for x in observables if x]
+            else:
+                observables = [data]
+
+            # observable: domain, DNSRequest contains is case insensitive
+            domains = dict()
+            for observable in observables:
+                if self.data_type == "url" or "://" in observable:
+                    domains[observable] = self.get_domain_from_url(observable).lower()
+                else:
+                    domains[observable] = observable.lower()
+            unique_domains = sorted(set(domains.values()))
+
+            cache_key = None
+            if self.cache is not None:
+                if self.service == "dns-lookups-batch":
+                    key_data = observables
+                else:
+                    key_data = domains[data]
+                cache_key = self.cache.key(
+                    self.s1_console_url,
+                    self.s1_account_id,
+                    self.service,
+                    key_data,
+                    self.hours_ago,
+                )
+                if not self.cache_bypass:
+                    results = self.cache.get(cache_key)
+                    if results is not None:
+                        results["cache"] = self.cache.stats()
+                        self.report(results)
+                        return
+
+            if self.service == "dns-lookups-batch":
+                batches = self.batch_queries(unique_domains)
+            else:
+                batches = [
+                    (
+                        DNS_QUERY.format(DNS_REQUEST_CONDITION.format(domains[data])),
+                        unique_domains,
+                    )
+                ]
+
+            dns_requests, metrics, task_metrics = self._run_queries(
+                [query for query, _ in batches], datetime.utcnow()
+            )
+
+            if dns_requests is not None:
+                agent_names = set()
+                for seen in dns_requests.values():
+                    agent_names.update(seen["agents"])
+                results = {"agent_names": sorted(agent_names)}
+
+                trie = DomainTrie()
+                for dns_request, seen in dns_requests.items():
+                    trie.add(dns_request, seen["agents"], seen["events"])
+
+                if self.service == "dns-lookups-batch":
+                    # send each DNS request back to the domain(s) it contains
+                    breakdowns = {
+                        domain: trie.breakdown(domain) for domain in unique_domains
+                    }
+                    results["observables"] = dict()
+                    for observable, domain in domains.items():
+                        domain_agents = set()
+                        for match in breakdowns[domain]:
+                            domain_agents.update(match["agent_names"])
+                        results["observables"][observable] = {
+                            "domain": domain,
+                            "agent_names": sorted(domain_agents),
+                            "domains": breakdowns[domain],
+                        }
+                    results["batches"] = [
+                        {"domains": batch_domains, "query_length": len(query)}
+                        for query, batch_domains in batches
+                    ]
+                else:
+                    results["domains"] = trie.breakdown(domains[data])
+
+                if cache_key is not None:
+                    self.cache.put(cache_key, results)
+                    results["cache"] = self.cache.stats()
+                results["query"] = metrics
+                if task_metrics:
+                    results["slices"] = task_metrics
+                self.report(results)
 
     def summary(self, raw):
-        if self.service == "dns-lookups":
+        if self.service in ("dns-lookups", "dns-lookups-batch"):
             count = len(raw.get("agent_names", []))
             if count == 0:
                 level = "safe"
             else:
                 level = "suspicious"
-            return {
-                "taxonomies": [self.build_taxonomy(level, "S1", "host_count", count)]
-            }
+            taxonomies = [self.build_taxonomy(level, "S1", "host_count", count)]
+
+            if self.service == "dns-lookups-batch":
+                matched = len(
+                    [x for x in raw.get("observables", {}).values() if x["agent_names"]]
+                )
+                taxonomies.append(
+                    self.build_taxonomy(level, "S1", "observables_matched", matched)
+                )
+            return {"taxonomies": taxonomies}
         return {}
 
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""Elasticsearch Analyzer Benchmark
+Run the Elasticsearch analyzer end to end, as Cortex does (one process per job,
+input/output in a job directory), for every service and mode against the local
+stand-in.  Reports latency percentiles, bytes transferred and the analyzer's
+peak RSS per service/mode.
+
+    python benchmarks/es_benchmark.py --docs 1000000 --runs 10
+    python benchmarks/es_benchmark.py --modes hits,summary --config es_slim=true
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from es_standin import Corpus, StandIn  # noqa: E402
+
+ANALYZER = os.path.join(
+    os.path.dirname(__file__), "..", "analyzers", "Elasticsearch", "elasticsearch.py"
+)
+SERVICES = (
+    "windows-user-login-ips",
+    "cisco-vpn-user-login-ips",
+    "cisco-vpn-ip-login-users",
+    "windows-user-ip-logins",
+)
+USER_SERVICES = ("windows-user-login-ips", "cisco-vpn-user-login-ips")
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * len(values))) - 1)]
+
+
+def parse_config(pairs):
+    config = dict()
+    for pair in pairs:
+        key, value = pair.split("=", 1)
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+def run_job(job_directory, job):
+    """Run Job
+    Run the analyzer on one job, returns wall time in ms, peak RSS in KB and the
+    output.
+    """
+    shutil.rmtree(os.path.join(job_directory, "output"), ignore_errors=True)
+    with open(os.path.join(job_directory, "input", "input.json"), "w") as f:
+        json.dump(job, f)
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, ANALYZER, job_directory],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = (time.perf_counter() - start) * 1000
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    with open(os.path.join(job_directory, "output", "output.json")) as f:
+        output = json.load(f)
+
+    return elapsed, usage.ru_maxrss, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--hours", type=int, default=12)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modes", default="hits,aggregate,stream,summary")
+    parser.add_argument("--delay-ms", type=int, default=0)
+    parser.add_argument(
+        "--config",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra analyzer config, value parsed as JSON if possible",
+    )
+    args = parser.parse_args()
+
+    corpus = Corpus(docs=args.docs, users=args.users, hours=args.hours)
+    stand_in = StandIn(corpus=corpus, delay_ms=args.delay_ms)
+    url = stand_in.start()
+
+    job_directory = tempfile.mkdtemp(prefix="es-benchmark-")
+    os.makedirs(os.path.join(job_directory, "input"))
+
+    print(
+        f"{'service':<28}{'mode':<11}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'requests':>10}{'sent B':>10}{'recv B':>12}{'RSS MB':>8}{'found':>7}"
+    )
+    try:
+        for service in SERVICES:
+            if service in USER_SERVICES:
+                data_type, data = "user", "user1"
+            else:
+                data_type, data = "ip", corpus.ip(1)
+
+            for mode in args.modes.split(","):
+                config = {
+                    "service": service,
+                    "es_url": url,
+                    "es_username": "benchmark",
+                    "es_password": "benchmark",
+                    "es_search_index": "logs-standin",
+                    "es_hours": args.hours,
+                    "es_mode": mode,
+                }
+                config.update(parse_config(args.config))
+                job = {"dataType": data_type, "data": data, "config": config}
+
+                latencies = list()
+                peak_rss = 0
+                stand_in.reset_counters()
+                for _ in range(args.runs):
+                    elapsed, rss, output = run_job(job_directory, job)
+                    if not output.get("success"):
+                        raise SystemExit(
+                            f"{service} {mode}: {output.get('errorMessage')}"
+                        )
+                    latencies.append(elapsed)
+                    peak_rss = max(peak_rss, rss)
+
+                counters = stand_in.counters()
+                found = output["full"].get(
+                    "total_ips", output["full"].get("total_users", 0)
+                )
+                print(
+                    f"{service:<28}{mode:<11}"
+                    f"{statistics.median(latencies):>9.1f}"
+                    f"{percentile(latencies, 95):>9.1f}"
+                    f"{percentile(latencies, 99):>9.1f}"
+                    f"{counters['requests'] // args.runs:>10}"
+                    f"{counters['request_bytes'] // args.runs:>10}"
+                    f"{counters['response_bytes'] // args.runs:>12}"
+                    f"{peak_rss / 1024:>8.1f}{found:>7}"
+                )
+    finally:
+        stand_in.stop()
+        shutil.rmtree(job_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""Elasticsearch Query Bodies Benchmark
+Compare the scoring match based query bodies the analyzer used to send with the
+filter context bodies from compile_query.  Each body is sent to the local
+stand-in and the request size and round trip latency are reported.  The stand-in
+does not score documents, so latency differences here come from payload size
+and serialization only; cluster side savings need a real cluster.
+
+    python benchmarks/es_query_bodies.py --iterations 500
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "analyzers", "Elasticsearch")
+)
+
+import elasticsearch  # noqa: E402
+from es_standin import StandIn  # noqa: E402
+
+OBSERVABLES = {"user.name": "user1", "source.ip": "10.0.0.1"}
+IGNORE_IPS = ["10.0.0.2", "10.0.0.3", "10.0.0.4", "192.168.0.0/16", "172.16.0.0/12"]
+
+
+def legacy_query(service, observable, hours, ignore_ips):
+    """Legacy Query
+    The query bodies as built before compile_query, match clauses in scoring
+    must/should context and one match per ignored IP.
+    """
+    observable_field = elasticsearch.SERVICE_FIELDS[service][0]
+    must = [
+        {"exists": {"field": "source.ip"}},
+        {"exists": {"field": "user.name"}},
+    ]
+    query = {"bool": {"must": must}}
+
+    if service in elasticsearch.WINDOWS_SERVICES:
+        must.append({"exists": {"field": "agent.hostname"}})
+        must.append({"match": {observable_field: observable}})
+        query["bool"]["should"] = [
+            {
+                "match": {
+                    "event.code": elasticsearch.WINDOWS_SUCCESSFUL_LOGON_EVENT_CODE
+                }
+            },
+            {
+                "match": {
+                    "event.code": elasticsearch.WINDOWS_UNSUCCESSFUL_LOGON_EVENT_CODE
+                }
+            },
+        ]
+        query["bool"]["minimum_should_match"] = 1
+    else:
+        must.append({"match": {observable_field: observable}})
+        must.append(
+            {"match": {"cisco.asa.message_id": elasticsearch.CISCO_VPN_MESSAGE_ID}}
+        )
+
+    query["bool"]["filter"] = {"range": {"@timestamp": {"gte": f"now-{hours}h"}}}
+
+    if elasticsearch.SERVICE_FIELDS[service][1] == "source.ip" and ignore_ips:
+        query["bool"]["must_not"] = [{"match": {"source.ip": ip}} for ip in ignore_ips]
+
+    return query
+
+
+def search_body(service, query):
+    if service in elasticsearch.WINDOWS_SERVICES:
+        source = elasticsearch.WINDOWS_SOURCE_FIELDS
+    else:
+        source = elasticsearch.CISCO_SOURCE_FIELDS
+
+    return {
+        "_source": source,
+        "sort": [{"@timestamp": {"order": "desc"}}],
+        "size": elasticsearch.MAX_RESULT_SIZE,
+        "query": query,
+    }
+
+
+def measure(session, url, body, iterations):
+    payload = json.dumps(body)
+    latencies = list()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = session.post(
+            url, data=payload, headers={"Content-Type": "application/json"}
+        )
+        response.json()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        "request_bytes": len(payload),
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--hours", type=int, default=elasticsearch.DEFAULT_HOURS)
+    args = parser.parse_args()
+
+    stand_in = StandIn()
+    url = stand_in.start() + "/logs-standin/_search"
+    session = requests.Session()
+
+    print(f"{'service':<28}{'body':<10}{'bytes':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    try:
+        for service in elasticsearch.SERVICES:
+            observable = OBSERVABLES[elasticsearch.SERVICE_FIELDS[service][0]]
+            bodies = {
+                "legacy": legacy_query(service, observable, args.hours, IGNORE_IPS),
+                "compiled": elasticsearch.compile_query(
+                    service, observable, args.hours, IGNORE_IPS
+                ),
+            }
+            for name, query in bodies.items():
+                result = measure(
+                    session, url, search_body(service, query), args.iterations
+                )
+                print(
+                    f"{service:<28}{name:<10}{result['request_bytes']:>8}"
+                    f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                )
+    finally:
+        stand_in.stop()
+
+
+if __name__ == "__main__":
+    main()
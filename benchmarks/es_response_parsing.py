@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Elasticsearch Response Parsing Benchmark
+Measure response size and JSON decode plus parse time per 10k hits for full
+"_source" responses and slim (es_slim) responses trimmed with filter_path and
+docvalue_fields.  No network is involved, both payloads are built locally from
+the stand-in's synthetic hits.
+
+    python benchmarks/es_response_parsing.py --hits 10000 --rounds 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "analyzers", "Elasticsearch")
+)
+
+import elasticsearch  # noqa: E402
+from es_standin import Corpus  # noqa: E402
+
+
+def full_response(hits):
+    return {
+        "took": 12,
+        "timed_out": False,
+        "_shards": {"total": 5, "successful": 5, "skipped": 0, "failed": 0},
+        "hits": {
+            "total": {"value": len(hits), "relation": "eq"},
+            "max_score": None,
+            "hits": hits,
+        },
+    }
+
+
+def slim_response(hits, fields):
+    # what filter_path=hits.hits.fields,hits.hits.sort leaves of a docvalue search
+    return {
+        "hits": {
+            "hits": [
+                {
+                    "fields": {
+                        field: [value]
+                        for field, value in elasticsearch.extract_fields(
+                            hit, fields
+                        ).items()
+                    },
+                    "sort": hit["sort"],
+                }
+                for hit in hits
+            ]
+        }
+    }
+
+
+def parser_for(service):
+    # the analyzer reads its job on init, parsing only needs the service
+    analyzer = object.__new__(elasticsearch.Elasticsearch)
+    analyzer.service = service
+    return analyzer
+
+
+def measure(payload, analyzer, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        json_data = json.loads(payload)
+        analyzer._parse_hits(json_data.get("hits", {}).get("hits", []))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--hits", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = Corpus(docs=args.hits)
+    hits = [corpus.hit(i) for i in range(args.hits)]
+    per = 10000 / args.hits
+
+    print(
+        f"{'service':<28}{'response':<10}{'bytes':>12}{'ms/10k hits':>14}{'bytes x':>10}"
+        f"{'time x':>8}"
+    )
+    for service in elasticsearch.SERVICES:
+        analyzer = parser_for(service)
+        fields = analyzer._source_fields()
+
+        full = json.dumps(full_response(hits)).encode()
+        slim = json.dumps(slim_response(hits, fields)).encode()
+
+        full_time = measure(full, analyzer, args.rounds)
+        slim_time = measure(slim, analyzer, args.rounds)
+
+        print(
+            f"{service:<28}{'full':<10}{len(full):>12}{full_time * 1000 * per:>14.1f}"
+        )
+        print(
+            f"{service:<28}{'slim':<10}{len(slim):>12}{slim_time * 1000 * per:>14.1f}"
+            f"{len(full) / len(slim):>10.1f}{full_time / slim_time:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
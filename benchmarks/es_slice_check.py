@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""Elasticsearch Slice Check
+Run the Elasticsearch analyzer unsliced and with es_slices against the local
+stand-in and check both reports match.  In summary mode the reports must be
+identical apart from the per run slice details and page counts.
+
+    python benchmarks/es_slice_check.py --docs 100000 --slices 4
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from es_benchmark import SERVICES, USER_SERVICES, run_job  # noqa: E402
+from es_standin import Corpus, StandIn  # noqa: E402
+
+# differ between sliced and unsliced runs by design
+RUN_KEYS = ("slices", "budget_reached", "aggregation_pages")
+
+
+def report(job_directory, job):
+    _, _, output = run_job(job_directory, job)
+    if not output.get("success"):
+        raise SystemExit(output.get("errorMessage"))
+    return {key: value for key, value in output["full"].items() if key not in RUN_KEYS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--hours", type=int, default=12)
+    parser.add_argument("--slices", type=int, default=4)
+    args = parser.parse_args()
+
+    # few users over many IPs so the summary has more than MAX_SUMMARY_GROUPS
+    corpus = Corpus(docs=args.docs, users=args.users, hours=args.hours)
+    stand_in = StandIn(corpus=corpus)
+    url = stand_in.start()
+
+    job_directory = tempfile.mkdtemp(prefix="es-slice-check-")
+    os.makedirs(os.path.join(job_directory, "input"))
+
+    failed = False
+    try:
+        for service in SERVICES:
+            if service in USER_SERVICES:
+                data_type, data = "user", "user1"
+            else:
+                data_type, data = "ip", corpus.ip(1)
+
+            config = {
+                "service": service,
+                "es_url": url,
+                "es_username": "check",
+                "es_password": "check",
+                "es_search_index": "logs-standin",
+                "es_hours": args.hours,
+                "es_mode": "summary",
+            }
+            job = {"dataType": data_type, "data": data, "config": config}
+            unsliced = report(job_directory, job)
+            config["es_slices"] = args.slices
+            sliced = report(job_directory, job)
+
+            if sliced == unsliced:
+                status = "ok"
+            else:
+                failed = True
+                keys = sorted(
+                    key
+                    for key in set(sliced) | set(unsliced)
+                    if sliced.get(key) != unsliced.get(key)
+                )
+                status = "differs: " + ", ".join(keys)
+            print(
+                f"{service:<28}{unsliced.get('summary_groups', 0):>7} groups  {status}"
+            )
+    finally:
+        stand_in.stop()
+        shutil.rmtree(job_directory, ignore_errors=True)
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+
+"""Elasticsearch Stand-in
+Local HTTP server implementing enough of the Elasticsearch API for the
+Elasticsearch analyzer to run against it: _search (bool queries with term,
+terms, match, exists, ids and range clauses, sort, search_after, _source and
+docvalue_fields), _msearch, point in time, composite aggregations with min/max
+sub-aggregations and filter_path.
+
+Documents are synthetic Windows 4624/4625 logons and Cisco ASA 722051 VPN
+logons.  Document i is computed from i alone, newest first, so volumes up to
+tens of millions need no storage.  A term on user.name or source.ip (and a
+range on @timestamp) narrows the documents visited to an arithmetic
+progression, other clauses are evaluated per document.
+
+    python benchmarks/es_standin.py --docs 1000000 --port 9200
+"""
+
+import argparse
+import ipaddress
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+CISCO_VPN_MESSAGE_ID = "722051"
+LOGON_TYPES = ["2", "3", "3", "3", "10", "5"]
+SUBSTATUS_CODES = ["0xC000006A", "0xC0000064", "0xC0000234", "0xC0000072"]
+DATE_MATH_RE = re.compile(r"^now(?:([+-])(\d+)([smhd]))?(?:/([smhd]))?$")
+DATE_MATH_UNITS = {"s": 1000, "m": 60 * 1000, "h": 3600 * 1000, "d": 86400 * 1000}
+TRACK_TOTAL_HITS = 10000
+MISSING = object()
+
+
+def to_iso(ms):
+    return (
+        datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%S.%f"
+        )[:-3]
+        + "Z"
+    )
+
+
+def parse_date(value, now):
+    """Parse Date
+    Epoch milliseconds for a number, date math ("now-12h/m") or ISO 8601 value.
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    if value.isdigit():
+        return int(value)
+
+    match = DATE_MATH_RE.match(value)
+    if match is not None:
+        sign, amount, unit, rounding = match.groups()
+        ms = now
+        if sign is not None:
+            delta = int(amount) * DATE_MATH_UNITS[unit]
+            ms = ms - delta if sign == "-" else ms + delta
+        if rounding is not None:
+            ms -= ms % DATE_MATH_UNITS[rounding]
+        return ms
+
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def nest(flat):
+    nested = dict()
+    for field, value in flat.items():
+        node = nested
+        parts = field.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, dict())
+        node[parts[-1]] = value
+    return nested
+
+
+def apply_filter_path(data, filter_path):
+    def walk(node, paths):
+        if any(len(path) == 0 for path in paths):
+            return node
+        if isinstance(node, list):
+            items = [walk(item, paths) for item in node]
+            return [item for item in items if item is not MISSING]
+        if isinstance(node, dict):
+            filtered = dict()
+            for key, value in node.items():
+                sub_paths = [path[1:] for path in paths if path[0] == key]
+                if sub_paths:
+                    value = walk(value, sub_paths)
+                    if value is not MISSING:
+                        filtered[key] = value
+            return filtered or MISSING
+        return MISSING
+
+    paths = [path.split(".") for path in filter_path.split(",")]
+    filtered = walk(data, paths)
+    return dict() if filtered is MISSING else filtered
+
+
+class Corpus:
+    """Corpus
+    Synthetic logon documents.  Document i is @timestamp now - i * interval,
+    user i % users, source IP i % ips and host i % hosts.  Every tenth
+    document of a user is a Cisco VPN logon, of the Windows ones every fourth
+    is a failed (4625) logon.
+    """
+
+    def __init__(self, docs=10000, users=50, ips=251, hosts=20, hours=12, now=None):
+        self.docs = docs
+        self.users = users
+        self.ips = ips
+        self.hosts = hosts
+        self.now = now if now is not None else int(time.time() * 1000)
+        self.interval = max(1, hours * 3600 * 1000 // docs)
+
+    def ip(self, p):
+        return f"10.{p // 65536 % 256}.{p // 256 % 256}.{p % 256}"
+
+    def ip_index(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version != 4 or not str(address).startswith("10."):
+            return None
+        return int(address) - int(ipaddress.ip_address("10.0.0.0"))
+
+    def timestamp(self, i):
+        return self.now - i * self.interval
+
+    def document(self, i):
+        k = i // self.users
+        document = {
+            "@timestamp": self.timestamp(i),
+            "source.ip": self.ip(i % self.ips),
+            "user.name": f"user{i % self.users}",
+        }
+
+        if k % 10 == 0:
+            document["agent.hostname"] = "asa-vpn-1"
+            document["event.code"] = CISCO_VPN_MESSAGE_ID
+            document["cisco.asa.message_id"] = CISCO_VPN_MESSAGE_ID
+        else:
+            document["agent.hostname"] = f"host{i % self.hosts}"
+            document["winlog.event_data.LogonType"] = LOGON_TYPES[k % len(LOGON_TYPES)]
+            if k % 4 == 3:
+                document["event.code"] = "4625"
+                document["winlog.event_data.SubStatus"] = SUBSTATUS_CODES[
+                    k // 4 % len(SUBSTATUS_CODES)
+                ]
+            else:
+                document["event.code"] = "4624"
+
+        return document
+
+    def document_id(self, i):
+        return f"standin-{i}"
+
+    def hit(self, i, source=True, docvalue_fields=None, index="logs-standin"):
+        document = self.document(i)
+        hit = {"_index": index, "_id": self.document_id(i), "_score": None}
+
+        if source is True:
+            flat = dict(document)
+            flat["@timestamp"] = to_iso(document["@timestamp"])
+            hit["_source"] = nest(flat)
+        elif source:
+            flat = {field: document[field] for field in source if field in document}
+            if "@timestamp" in flat:
+                flat["@timestamp"] = to_iso(flat["@timestamp"])
+            hit["_source"] = nest(flat)
+
+        if docvalue_fields:
+            fields = dict()
+            for field in docvalue_fields:
+                if isinstance(field, dict):
+                    field = field["field"]
+                if field in document:
+                    value = document[field]
+                    if field == "@timestamp":
+                        value = to_iso(value)
+                    fields[field] = [value]
+            hit["fields"] = fields
+
+        hit["sort"] = [document["@timestamp"]]
+        return hit
+
+    def candidates(self, query, descending=True, extra=()):
+        """Candidates
+        Document numbers that can match query, in @timestamp order.  Narrowed by
+        a top level term on user.name/source.ip and @timestamp ranges in query or
+        the extra clauses.
+        """
+        start, stop, step, offset = 0, self.docs, 1, 0
+
+        clauses = list(extra)
+        if "bool" in query:
+            for occur in ("filter", "must"):
+                occur_clauses = query["bool"].get(occur, [])
+                if isinstance(occur_clauses, dict):
+                    occur_clauses = [occur_clauses]
+                clauses += occur_clauses
+        else:
+            clauses.append(query)
+
+        for clause in clauses:
+            for kind in ("term", "match"):
+                if kind not in clause:
+                    continue
+                field, value = next(iter(clause[kind].items()))
+                if isinstance(value, dict):
+                    value = value.get("value", value.get("query"))
+                if field == "user.name" and str(value).startswith("user"):
+                    number = str(value)[4:]
+                    if not number.isdigit() or int(number) >= self.users:
+                        return range(0)
+                    step, offset = self.users, int(number)
+                elif field == "source.ip" and "/" not in str(value):
+                    number = self.ip_index(str(value))
+                    if number is None or number >= self.ips:
+                        return range(0)
+                    step, offset = self.ips, number
+
+            if "range" in clause and "@timestamp" in clause["range"]:
+                bounds = clause["range"]["@timestamp"]
+                if "gte" in bounds:
+                    oldest = parse_date(bounds["gte"], self.now)
+                    stop = min(stop, (self.now - oldest) // self.interval + 1)
+                if "gt" in bounds:
+                    oldest = parse_date(bounds["gt"], self.now) + 1
+                    stop = min(stop, (self.now - oldest) // self.interval + 1)
+                if "lt" in bounds:
+                    newest = parse_date(bounds["lt"], self.now) - 1
+                    start = max(start, -((newest - self.now) // self.interval))
+                if "lte" in bounds:
+                    newest = parse_date(bounds["lte"], self.now)
+                    start = max(start, -((newest - self.now) // self.interval))
+
+        start = max(start, 0)
+        first = start + (offset - start) % step
+        numbers = range(first, max(stop, first), step)
+        return numbers if descending else numbers[::-1]
+
+    def matches(self, query, document, i=None):
+        """Matches
+        Whether document (number i, needed for ids queries) matches query.
+        """
+        if "bool" in query:
+            bool_query = query["bool"]
+            for occur in ("filter", "must"):
+                clauses = bool_query.get(occur, [])
+                if isinstance(clauses, dict):
+                    clauses = [clauses]
+                if not all(self.matches(clause, document, i) for clause in clauses):
+                    return False
+
+            must_not = bool_query.get("must_not", [])
+            if isinstance(must_not, dict):
+                must_not = [must_not]
+            if any(self.matches(clause, document, i) for clause in must_not):
+                return False
+
+            should = bool_query.get("should", [])
+            if should:
+                minimum = bool_query.get("minimum_should_match", 0)
+                matched = sum(self.matches(clause, document, i) for clause in should)
+                if matched < minimum:
+                    return False
+            return True
+
+        if "ids" in query:
+            return i is not None and self.document_id(i) in query["ids"]["values"]
+
+        if "exists" in query:
+            return query["exists"]["field"] in document
+
+        for kind in ("term", "match"):
+            if kind in query:
+                field, value = next(iter(query[kind].items()))
+                if isinstance(value, dict):
+                    value = value.get("value", value.get("query"))
+                return self._equals(field, document.get(field), value)
+
+        if "terms" in query:
+            field, values = next(iter(query["terms"].items()))
+            return any(self._equals(field, document.get(field), v) for v in values)
+
+        if "range" in query:
+            field, bounds = next(iter(query["range"].items()))
+            if field not in document:
+                return False
+            value = document[field]
+            if "gte" in bounds and value < parse_date(bounds["gte"], self.now):
+                return False
+            if "gt" in bounds and value <= parse_date(bounds["gt"], self.now):
+                return False
+            if "lt" in bounds and value >= parse_date(bounds["lt"], self.now):
+                return False
+            if "lte" in bounds and value > parse_date(bounds["lte"], self.now):
+                return False
+            return True
+
+        if "match_all" in query:
+            return True
+
+        raise ValueError(f"unsupported query: {list(query)}")
+
+    def _equals(self, field, actual, expected):
+        if actual is None:
+            return False
+        if field == "source.ip" and "/" in str(expected):
+            return ipaddress.ip_address(actual) in ipaddress.ip_network(
+                expected, strict=False
+            )
+        return str(actual) == str(expected)
+
+    def search(self, body):
+        query = body.get("query", {"match_all": {}})
+        size = body.get("size", 10)
+
+        descending = True
+        for sort in body.get("sort", []):
+            if isinstance(sort, dict) and "@timestamp" in sort:
+                order = sort["@timestamp"]
+                if isinstance(order, dict):
+                    order = order.get("order", "desc")
+                descending = order == "desc"
+
+        # search_after on the single @timestamp sort value is a range bound
+        extra = list()
+        if body.get("search_after") is not None:
+            bound = "lt" if descending else "gt"
+            extra.append({"range": {"@timestamp": {bound: body["search_after"][0]}}})
+
+        hits = list()
+        total = 0
+        for i in self.candidates(query, descending, extra):
+            if not self.matches(query, self.document(i), i):
+                continue
+            total += 1
+            if len(hits) < size:
+                hits.append(
+                    self.hit(
+                        i,
+                        body.get("_source", True),
+                        body.get("docvalue_fields"),
+                    )
+                )
+            elif body.get("track_total_hits") is False or total >= TRACK_TOTAL_HITS:
+                break
+
+        response = {
+            "took": 1,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {"max_score": None, "hits": hits},
+        }
+        if body.get("track_total_hits") is not False:
+            relation = "gte" if total >= TRACK_TOTAL_HITS else "eq"
+            response["hits"]["total"] = {"value": total, "relation": relation}
+
+        if "aggs" in body:
+            response["aggregations"] = {
+                name: self.composite(query, aggregation)
+                for name, aggregation in body["aggs"].items()
+            }
+
+        return response
+
+    def composite(self, query, aggregation):
+        composite = aggregation["composite"]
+        sources = list()
+        missing_bucket = list()
+        for source in composite["sources"]:
+            name, definition = next(iter(source.items()))
+            sources.append((name, definition["terms"]["field"]))
+            missing_bucket.append(definition["terms"].get("missing_bucket", False))
+        sub_aggregations = aggregation.get("aggs", dict())
+
+        groups = dict()
+        for i in self.candidates(query):
+            document = self.document(i)
+            if not self.matches(query, document, i):
+                continue
+            key = tuple(document.get(field) for _, field in sources)
+            if any(k is None and not ok for k, ok in zip(key, missing_bucket)):
+                continue
+            group = groups.setdefault(key, [0, None, None])
+            group[0] += 1
+            timestamp = document["@timestamp"]
+            group[1] = timestamp if group[1] is None else min(group[1], timestamp)
+            group[2] = timestamp if group[2] is None else max(group[2], timestamp)
+
+        def order(key):
+            return tuple((k is not None, k) for k in key)
+
+        keys = sorted(groups, key=order)
+        if "after" in composite:
+            after = tuple(composite["after"].get(name) for name, _ in sources)
+            keys = [key for key in keys if order(key) > order(after)]
+        keys = keys[: composite.get("size", 10)]
+
+        buckets = list()
+        for key in keys:
+            count, oldest, newest = groups[key]
+            bucket = {
+                "key": {name: k for (name, _), k in zip(sources, key)},
+                "doc_count": count,
+            }
+            for name, definition in sub_aggregations.items():
+                value = oldest if "min" in definition else newest
+                bucket[name] = {"value": float(value), "value_as_string": to_iso(value)}
+            buckets.append(bucket)
+
+        result = {"buckets": buckets}
+        if buckets:
+            result["after_key"] = buckets[-1]["key"]
+        return result
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._route()
+
+    def do_POST(self):
+        self._route()
+
+    def do_DELETE(self):
+        self._route()
+
+    def _route(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split("/") if part]
+
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.request_bytes += length
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        corpus = self.server.corpus
+        try:
+            if parts and parts[-1] == "_msearch":
+                lines = [line for line in raw.decode().split("\n") if line.strip()]
+                responses = list()
+                for body in lines[1::2]:
+                    response = corpus.search(json.loads(body))
+                    response["status"] = 200
+                    responses.append(response)
+                self._send(200, {"took": 1, "responses": responses}, params)
+
+            elif parts and parts[-1] == "_pit":
+                if self.command == "DELETE":
+                    self._send(200, {"succeeded": True, "num_freed": 1}, params)
+                else:
+                    self._send(200, {"id": uuid.uuid4().hex}, params)
+
+            elif parts and parts[-1] == "_search":
+                body = json.loads(raw or b"{}")
+                response = corpus.search(body)
+                if "pit" in body:
+                    response["pit_id"] = body["pit"]["id"]
+                self._send(200, response, params)
+
+            else:
+                self._send(404, {"error": "not found", "status": 404}, params)
+        except (KeyError, ValueError) as e:
+            self._send(400, {"error": {"type": "parsing_exception", "reason": str(e)}})
+
+    def _send(self, status, data, params=None):
+        if params and "filter_path" in params:
+            data = apply_filter_path(data, params["filter_path"])
+
+        payload = json.dumps(data).encode()
+        with self.server.lock:
+            self.server.response_bytes += len(payload)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StandIn:
+    def __init__(self, host="127.0.0.1", port=0, corpus=None, delay_ms=0):
+        self.server = ThreadingHTTPServer((host, port), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.corpus = corpus if corpus is not None else Corpus()
+        self.server.delay = delay_ms / 1000
+        self.server.lock = threading.Lock()
+        self.reset_counters()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def corpus(self):
+        return self.server.corpus
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def counters(self):
+        with self.server.lock:
+            return {
+                "requests": self.server.requests,
+                "request_bytes": self.server.request_bytes,
+                "response_bytes": self.server.response_bytes,
+            }
+
+    def reset_counters(self):
+        self.server.requests = 0
+        self.server.request_bytes = 0
+        self.server.response_bytes = 0
+
+    def start(self):
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--docs", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--hours", type=int, default=12)
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--delay-ms", type=int, default=0)
+    args = parser.parse_args()
+
+    stand_in = StandIn(
+        port=args.port,
+        corpus=Corpus(docs=args.docs, users=args.users, hours=args.hours),
+        delay_ms=args.delay_ms,
+    )
+    print(f"Elasticsearch stand-in with {args.docs} documents on {stand_in.url}")
+    stand_in.server.serve_forever()
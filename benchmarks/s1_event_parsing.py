@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""SentinelOne Event Parsing Benchmark
+Compare the regex scan the SentinelOne analyzer used on get-events pages with
+the streaming EventStream parser.  Pages of synthetic Deep Visibility events are
+built locally and fed to both in chunks, as requests would read them off the
+socket.  Reports throughput, peak traced memory and the agent names each
+approach found (the regex misses names with escaped quotes and breaks on
+whitespace after colons).
+
+    python benchmarks/s1_event_parsing.py --events 5000 --rounds 3
+    python benchmarks/s1_event_parsing.py --events 20000 --indent
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "analyzers", "SentinelOne")
+)
+
+import SentinelOne  # noqa: E402
+
+AGENT_NAME_RE = re.compile(r'"agentName":"([^"]+)"')
+NEXT_CURSOR_NONE = '"nextCursor":null,'
+NEXT_CURSOR_RE = re.compile(r'"nextCursor":"([^"]+)"')
+
+
+def event(i, rng):
+    """Event
+    A DNS event shaped like Deep Visibility's, most of its size is fields the
+    analyzer does not read.
+    """
+    agent = f"WKS-{i % 500:04d}"
+    if i % 97 == 0:
+        agent = f'LAB "{i % 7}" PC'
+    return {
+        "agentDomain": "corp.example.com",
+        "agentGroupId": str(rng.getrandbits(60)),
+        "agentId": str(rng.getrandbits(60)),
+        "agentInfected": False,
+        "agentIp": f"10.{i % 250}.{i % 200}.{i % 100}",
+        "agentIsActive": True,
+        "agentIsDecommissioned": False,
+        "agentMachineType": "laptop",
+        "agentName": agent,
+        "agentNetworkStatus": "connected",
+        "agentOs": "windows",
+        "agentUuid": f"{rng.getrandbits(128):032x}",
+        "agentVersion": "21.7.5.1080",
+        "createdAt": "2021-09-14T12:00:00.000000Z",
+        "dnsRequest": None,
+        "DNSRequest": f"cdn{i % 40}.evil{i % 3}.example.net",
+        "dnsResponse": f"type: 1 10.1.{i % 255}.{i % 250};",
+        "eventType": "DNS Resolved",
+        "id": str(rng.getrandbits(60)),
+        "objectType": "dns",
+        "parentProcessName": "services.exe",
+        "pid": str(rng.randint(100, 65000)),
+        "processCmd": "C:\\Windows\\system32\\svchost.exe -k NetworkService -p",
+        "processDisplayName": "Host Process for Windows Services",
+        "processImagePath": "C:\\Windows\\System32\\svchost.exe",
+        "processImageSha1Hash": f"{rng.getrandbits(160):040x}",
+        "processName": "svchost.exe",
+        "processUniqueKey": f"{rng.getrandbits(64):016X}",
+        "processUserName": "NT AUTHORITY\\NETWORK SERVICE",
+        "siteName": "Default site",
+        "srcProcStorylineId": f"{rng.getrandbits(64):016X}",
+        "trueContext": f"{rng.getrandbits(64):016X}",
+        "user": "NT AUTHORITY\\NETWORK SERVICE",
+    }
+
+
+def page(events, indent):
+    body = {
+        "data": events,
+        "pagination": {"nextCursor": None, "totalItems": len(events)},
+    }
+    if indent:
+        return json.dumps(body, indent=2).encode()
+    return json.dumps(body, separators=(",", ":")).encode()
+
+
+def chunks(body, size):
+    for i in range(0, len(body), size):
+        yield body[i : i + size]
+
+
+def parse_regex(body, chunk_size):
+    # requests joins the chunks into response.content, .text decodes all of it
+    text = b"".join(chunks(body, chunk_size)).decode("utf-8")
+    names = set()
+    if NEXT_CURSOR_NONE not in text:
+        NEXT_CURSOR_RE.search(text)
+    for m in AGENT_NAME_RE.finditer(text):
+        names.add(m[1])
+    return names
+
+
+def parse_stream(body, chunk_size):
+    stream = SentinelOne.EventStream(chunks(body, chunk_size))
+    names = set()
+    for item in stream.events():
+        if "agentName" in item:
+            names.add(item["agentName"])
+    (stream.fields.get("pagination") or {}).get("nextCursor")
+    return names
+
+
+def measure(parse, body, chunk_size, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        names = parse(body, chunk_size)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    parse(body, chunk_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak, names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=SentinelOne.EVENTS_CHUNK_SIZE)
+    parser.add_argument(
+        "--indent", action="store_true", help="pretty printed page, as from a proxy"
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    body = page([event(i, rng) for i in range(args.events)], args.indent)
+    expected = {event(i, rng)["agentName"] for i in range(args.events)}
+    mb = len(body) / 1024 / 1024
+
+    print(f"page: {args.events} events, {mb:.1f} MB, {len(expected)} agent names")
+    print(
+        f"{'parser':<10}{'MB/s':>9}{'ms':>10}{'peak MB':>10}{'names':>8}{'missed':>8}"
+    )
+    for name, parse in (("regex", parse_regex), ("stream", parse_stream)):
+        elapsed, peak, names = measure(parse, body, args.chunk_size, args.rounds)
+        print(
+            f"{name:<10}{mb / elapsed:>9.1f}{elapsed * 1000:>10.1f}"
+            f"{peak / 1024 / 1024:>10.1f}{len(names):>8}{len(expected - names):>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
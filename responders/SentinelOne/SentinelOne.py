@@ -1,9 +1,574 @@
 #!/usr/bin/env python3
 
+import fcntl
+import hashlib
+import json
+import os
+import random
 import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
 from cortexutils.responder import Responder
 import requests
 
+BULK_SEPARATORS = re.compile(r"[\s,;]+")
+DEFAULT_BULK_WORKERS = 4
+DEFAULT_INDEX_TTL = 24 * 60 * 60
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RATE_LIMIT = 5.0
+DEFAULT_RATE_LIMIT_BURST = 10
+DEFAULT_RETRY_SECONDS = 1.0
+DEFAULT_SPOOL_BATCH = 50
+MAX_RETRY_SECONDS = 60.0
+MAX_SPOOL_ATTEMPTS = 10
+MAX_SPOOL_RETRY_SECONDS = 300
+RESTRICTIONS_API_ENDPOINT = "/web/api/v2.1/restrictions"
+RESTRICTIONS_PAGE_SIZE = 1000
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+SPOOL_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+
+class RateLimiter:
+    """Rate Limiter
+    Token bucket shared by every process on the host through a lock file holding
+    the bucket state, the SentinelOne analyzer uses the same file for a console.
+    Tokens refill at rate per second up to burst, acquire blocks until one is
+    available.  block() holds every process off the API until a time, e.g. from a
+    429 Retry-After.
+    """
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self._state() as state:
+                now = time.time()
+                if state["blocked_until"] > now:
+                    wait = state["blocked_until"] - now
+                elif state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    return waited
+                else:
+                    wait = (1 - state["tokens"]) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def block(self, seconds):
+        with self._state() as state:
+            state["blocked_until"] = max(state["blocked_until"], time.time() + seconds)
+
+    @contextmanager
+    def _state(self):
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read())
+            except ValueError:
+                state = {
+                    "tokens": float(self.burst),
+                    "updated": 0.0,
+                    "blocked_until": 0.0,
+                }
+
+            now = time.time()
+            state["tokens"] = min(
+                float(self.burst),
+                state["tokens"] + max(0.0, now - state["updated"]) * self.rate,
+            )
+            state["updated"] = now
+            try:
+                yield state
+            finally:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+
+
+class Blacklister:
+    """Blacklister
+    Client for the SentinelOne restrictions API, used by the responder and the
+    spool flusher.  Takes plain config values so a flusher process can build one
+    from the config the responder hands it.
+    """
+
+    def __init__(
+        self,
+        console_url,
+        api_key,
+        account_id,
+        os_type="windows",
+        proxies=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+        rate_limit=DEFAULT_RATE_LIMIT,
+        rate_limit_burst=DEFAULT_RATE_LIMIT_BURST,
+        rate_limit_path=None,
+    ):
+        self.config = {
+            "console_url": console_url,
+            "api_key": api_key,
+            "account_id": account_id,
+            "os_type": os_type,
+            "proxies": proxies,
+            "max_retries": max_retries,
+            "rate_limit": rate_limit,
+            "rate_limit_burst": rate_limit_burst,
+            "rate_limit_path": rate_limit_path,
+        }
+        self.console_url = console_url
+        self.account_id = account_id
+        self.os_type = os_type
+        self.type = "black_hash"
+        self.proxies = proxies
+        self.max_retries = max_retries
+
+        self.headers = {
+            "Authorization": f"ApiToken {api_key}",
+            "User-Agent": "Cortex/SentinelOne-Responder",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+
+        # API calls from every process on the host share one rate limit per console
+        self.rate_limiter = None
+        if rate_limit > 0:
+            if rate_limit_path is None:
+                rate_limit_path = os.path.join(
+                    tempfile.gettempdir(),
+                    "sentinelone-"
+                    + hashlib.sha256(console_url.encode()).hexdigest()[:16]
+                    + ".ratelimit",
+                )
+            self.rate_limiter = RateLimiter(
+                rate_limit_path, rate_limit, rate_limit_burst
+            )
+
+    def request(self, method, path, **kwargs):
+        """Request
+        Call the API once the shared rate limiter allows it.  429, 502, 503 and 504
+        responses are retried up to max_retries times, waiting for Retry-After if
+        sent (other processes wait too) or backing off exponentially with jitter.
+        The last response is returned either way.
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            response = requests.request(
+                method,
+                f"{self.console_url}{path}",
+                headers=self.headers,
+                proxies=self.proxies,
+                **kwargs,
+            )
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt == self.max_retries
+            ):
+                return response
+
+            delay = self.retry_after(response)
+            if delay is None:
+                delay = random.uniform(0, DEFAULT_RETRY_SECONDS * 2**attempt)
+            else:
+                delay = min(delay, MAX_RETRY_SECONDS)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.block(delay)
+            time.sleep(delay)
+
+    def retry_after(self, response):
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(
+                0.0,
+                (
+                    parsedate_to_datetime(value) - datetime.now(timezone.utc)
+                ).total_seconds(),
+            )
+        except (TypeError, ValueError):
+            return None
+
+    def blacklist(self, value):
+        return self.request(
+            "POST",
+            RESTRICTIONS_API_ENDPOINT,
+            json={
+                "data": {"type": self.type, "value": value, "osType": self.os_type},
+                "filter": {"accountIds": [self.account_id]},
+            },
+        )
+
+
+class RestrictionIndex:
+    """Restriction Index
+    Local SQLite copy of an account's existing restrictions of one type, so bulk
+    requests only submit values that are not restricted yet.  Refreshed
+    incrementally from the newest createdAt held, rebuilt once older than ttl so
+    deleted restrictions drop out.
+    """
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS restrictions (value TEXT NOT NULL, "
+                "os_type TEXT NOT NULL, created_at TEXT, PRIMARY KEY (value, os_type))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL)"
+            )
+
+    def needs_rebuild(self):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE name = 'rebuilt'"
+        ).fetchone()
+        return row is None or row[0] < time.time() - self.ttl
+
+    def latest(self):
+        return self.connection.execute(
+            "SELECT MAX(created_at) FROM restrictions"
+        ).fetchone()[0]
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM restrictions")
+
+    def add(self, rows):
+        """Add
+        rows are (value, os_type, created_at), created_at may be None.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO restrictions (value, os_type, created_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(value, os_type) DO UPDATE "
+                "SET created_at = COALESCE(excluded.created_at, created_at)",
+                [
+                    (value.lower(), os_type, created_at)
+                    for value, os_type, created_at in rows
+                ],
+            )
+
+    def mark_rebuilt(self):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('rebuilt', ?)",
+                (time.time(),),
+            )
+
+    def present(self, values, os_type):
+        present = set()
+        values = list(values)
+        for i in range(0, len(values), 500):
+            chunk = values[i : i + 500]
+            present.update(
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT value FROM restrictions WHERE os_type = ? AND value IN "
+                    f"({','.join('?' * len(chunk))})",
+                    [os_type] + chunk,
+                )
+            )
+        return present
+
+
+class Spool:
+    """Spool
+    Write-ahead SQLite queue of blacklist actions.  The responder records intents
+    and returns, a flusher process posts them.  Each action has an idempotency key
+    (account, type, OS type, value) so recording one twice, or retrying a post,
+    never creates a second restriction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS actions (id INTEGER PRIMARY KEY, "
+                "key TEXT NOT NULL UNIQUE, account_id TEXT NOT NULL, "
+                "type TEXT NOT NULL, os_type TEXT NOT NULL, value TEXT NOT NULL, "
+                "status TEXT NOT NULL, created REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, "
+                "finished REAL, last_error TEXT)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS actions_pending "
+                "ON actions (status, next_attempt)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL)"
+            )
+
+    def enqueue(self, account_id, type, os_type, values):
+        """Enqueue
+        Record blacklist intents, returns how many were new.  Values already
+        pending or done are left alone, failed ones are queued again.
+        """
+        now = time.time()
+        rows = [
+            (
+                hashlib.sha256(
+                    f"{account_id} {type} {os_type} {value}".encode()
+                ).hexdigest(),
+                account_id,
+                type,
+                os_type,
+                value,
+                now,
+                now,
+            )
+            for value in values
+        ]
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT INTO actions (key, account_id, type, os_type, value, status, "
+                "created, next_attempt) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET status = 'pending', attempts = 0, "
+                "created = excluded.created, next_attempt = excluded.next_attempt, "
+                "finished = NULL WHERE status = 'failed'",
+                rows,
+            )
+            return self.connection.total_changes - before
+
+    def claim(self, limit):
+        return self.connection.execute(
+            "SELECT id, value, os_type, attempts, created FROM actions "
+            "WHERE status = 'pending' AND next_attempt <= ? "
+            "ORDER BY next_attempt, id LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+
+    def next_attempt(self):
+        return self.connection.execute(
+            "SELECT MIN(next_attempt) FROM actions WHERE status = 'pending'"
+        ).fetchone()[0]
+
+    def finish(self, done, retry, failed):
+        """Finish
+        done is a list of ids, retry a list of (id, attempts, error, delay) and
+        failed a list of (id, error).
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE actions SET status = 'done', finished = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                [(now, action_id) for action_id in done],
+            )
+            self.connection.executemany(
+                "UPDATE actions SET attempts = ?, last_error = ?, next_attempt = ? "
+                "WHERE id = ?",
+                [
+                    (attempts, error, now + delay, action_id)
+                    for action_id, attempts, error, delay in retry
+                ],
+            )
+            self.connection.executemany(
+                "UPDATE actions SET status = 'failed', finished = ?, "
+                "attempts = attempts + 1, last_error = ? WHERE id = ?",
+                [(now, error, action_id) for action_id, error in failed],
+            )
+            self.connection.execute(
+                "DELETE FROM actions WHERE status != 'pending' AND finished < ?",
+                (now - SPOOL_RETENTION_SECONDS,),
+            )
+
+    def set_meta(self, **values):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                values.items(),
+            )
+
+    def stats(self):
+        """Stats
+        Queue depth, failed actions, age of the oldest pending action and the
+        last flush's latency (record to post) for alerting on backlog.
+        """
+        now = time.time()
+        depth, oldest = self.connection.execute(
+            "SELECT COUNT(*), MIN(created) FROM actions WHERE status = 'pending'"
+        ).fetchone()
+        failed = self.connection.execute(
+            "SELECT COUNT(*) FROM actions WHERE status = 'failed'"
+        ).fetchone()[0]
+        stats = {"queue_depth": depth, "failed": failed, "oldest_pending_seconds": None}
+        if oldest is not None:
+            stats["oldest_pending_seconds"] = round(now - oldest, 3)
+        for name, value in self.connection.execute("SELECT name, value FROM meta"):
+            stats[name] = value
+        return stats
+
+
+class SpoolFlusher:
+    """Spool Flusher
+    Drains a spool in batches of batch_size, posting up to workers actions at
+    once.  Created or already existing (409) restrictions are done, 429, 502,
+    503, 504 and connection errors are retried with exponential backoff up to
+    MAX_SPOOL_ATTEMPTS, other errors (500 included) fail the action.  Done actions are added to
+    the restriction index when one is given.  One flusher runs per spool, it
+    exits once nothing is pending.
+    """
+
+    def __init__(self, spool, blacklister, batch_size, workers, index=None):
+        self.spool = spool
+        self.blacklister = blacklister
+        self.batch_size = batch_size
+        self.workers = workers
+        self.index = index
+
+    def run(self):
+        while True:
+            with open(self.spool.path + ".lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # another flusher owns the spool
+                    return
+                self._drain()
+
+            # an action recorded while the lock was being released has no flusher
+            if self.spool.next_attempt() is None:
+                return
+
+    def _drain(self):
+        while True:
+            actions = self.spool.claim(self.batch_size)
+            if not actions:
+                next_attempt = self.spool.next_attempt()
+                if next_attempt is None:
+                    return
+                time.sleep(
+                    max(0.0, min(next_attempt - time.time(), MAX_SPOOL_RETRY_SECONDS))
+                )
+                continue
+
+            started = time.time()
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                outcomes = list(executor.map(self._post, actions))
+
+            done, retry, failed = list(), list(), list()
+            for (action_id, _, _, attempts, created), (outcome, error) in zip(
+                actions, outcomes
+            ):
+                if outcome == "done":
+                    done.append(action_id)
+                elif outcome == "retry" and attempts + 1 < MAX_SPOOL_ATTEMPTS:
+                    delay = min(MAX_SPOOL_RETRY_SECONDS, 5 * 2**attempts)
+                    retry.append(
+                        (
+                            action_id,
+                            attempts + 1,
+                            error,
+                            random.uniform(delay / 2, delay),
+                        )
+                    )
+                else:
+                    failed.append((action_id, error))
+            self.spool.finish(done, retry, failed)
+
+            done = set(done)
+            if self.index is not None:
+                self.index.add(
+                    (value, os_type, None)
+                    for action_id, value, os_type, _, _ in actions
+                    if action_id in done
+                )
+
+            # latency is the longest an action posted in this flush waited
+            now = time.time()
+            created = [c for action_id, _, _, _, c in actions if action_id in done]
+            meta = {"last_flush": now, "last_flush_seconds": round(now - started, 3)}
+            if created:
+                meta["last_flush_latency_seconds"] = round(now - min(created), 3)
+            self.spool.set_meta(**meta)
+
+    def _post(self, action):
+        _, value, os_type, _, _ = action
+        if os_type != self.blacklister.os_type:
+            blacklister = Blacklister(**dict(self.blacklister.config, os_type=os_type))
+        else:
+            blacklister = self.blacklister
+
+        try:
+            response = blacklister.blacklist(value)
+        except requests.RequestException as e:
+            return "retry", str(e)
+
+        if response.status_code in (requests.codes.ok, requests.codes.conflict):
+            return "done", None
+        if response.status_code in RETRY_STATUS_CODES:
+            return "retry", f"{response.status_code} status code"
+        return "failed", f"{response.status_code} status code"
+
+
+def start_flusher(spool_path, config):
+    """Start Flusher
+    Start a detached flusher process for the spool, config (Blacklister
+    arguments, including the API key) is passed on stdin rather than stored.
+    """
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "flush", spool_path],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    process.stdin.write(json.dumps(config).encode())
+    process.stdin.close()
+
+
+def flush(spool_path):
+    config = json.loads(sys.stdin.read())
+    batch_size = config.pop("batch_size", DEFAULT_SPOOL_BATCH)
+    workers = config.pop("workers", DEFAULT_BULK_WORKERS)
+    index_path = config.pop("index_path", None)
+    index_ttl = config.pop("index_ttl", DEFAULT_INDEX_TTL)
+    index = None
+    if index_path is not None:
+        index = RestrictionIndex(index_path, index_ttl)
+    SpoolFlusher(
+        Spool(spool_path), Blacklister(**config), batch_size, workers, index
+    ).run()
+
 
 class SentinelOne(Responder):
     def __init__(self):
@@ -25,23 +590,208 @@ class SentinelOne(Responder):
             "data.dataType", None, "Data type is empty!"
         )
 
-        self.headers = {
-            "Authorization": f"ApiToken {self.s1_api_key}",
-            "User-Agent": "Cortex/SentinelOne-Responder",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
-
         self.service = self.get_param("config.service", None, "Service Missing!")
         self.sha1_re = re.compile(r"^[A-Za-z0-9]{40}$")
-        self.s1_blacklist_api_endpoint = "/web/api/v2.1/restrictions"
+        self.s1_blacklist_api_endpoint = RESTRICTIONS_API_ENDPOINT
 
         self.proxies = self.get_param("config.proxy", None)
 
+        self.bulk_workers = int(
+            self.get_param("config.s1_bulk_workers", DEFAULT_BULK_WORKERS)
+        )
+        self.index_path = self.get_param(
+            "config.s1_restrictions_index_path",
+            os.path.join(
+                tempfile.gettempdir(),
+                "sentinelone-"
+                + hashlib.sha256(
+                    f"{self.s1_console_url} {self.s1_account_id}".encode()
+                ).hexdigest()[:16]
+                + ".restrictions.db",
+            ),
+        )
+        self.index_ttl = int(
+            self.get_param("config.s1_restrictions_index_ttl", DEFAULT_INDEX_TTL)
+        )
+
+        self.blacklister = Blacklister(
+            self.s1_console_url,
+            self.s1_api_key,
+            self.s1_account_id,
+            os_type=self.s1_blacklist_ostype,
+            proxies=self.proxies,
+            max_retries=int(
+                self.get_param("config.s1_max_retries", DEFAULT_MAX_RETRIES)
+            ),
+            rate_limit=float(
+                self.get_param("config.s1_rate_limit", DEFAULT_RATE_LIMIT)
+            ),
+            rate_limit_burst=int(
+                self.get_param("config.s1_rate_limit_burst", DEFAULT_RATE_LIMIT_BURST)
+            ),
+            rate_limit_path=self.get_param("config.s1_rate_limit_path", None),
+        )
+
+        # actions are queued for the flusher when a spool is configured
+        self.spool_path = self.get_param("config.s1_spool_path", None)
+        self.spool_batch = int(
+            self.get_param("config.s1_spool_batch", DEFAULT_SPOOL_BATCH)
+        )
+
+    def _refresh_index(self, index):
+        """Refresh Index
+        Pull restrictions created since the newest one in the index (all of them
+        when the index is rebuilt) for the account.
+        """
+        rebuild = index.needs_rebuild()
+        params = {
+            "type": self.s1_blacklist_type,
+            "accountIds": self.s1_account_id,
+            "limit": RESTRICTIONS_PAGE_SIZE,
+            "sortBy": "createdAt",
+            "sortOrder": "asc",
+        }
+        if not rebuild and index.latest() is not None:
+            params["createdAt__gt"] = index.latest()
+
+        rows = list()
+        while True:
+            response = self.blacklister.request(
+                "GET", self.s1_blacklist_api_endpoint, params=params
+            )
+            if response.status_code != requests.codes.ok:
+                self.error(
+                    f"Error, unable to read existing restrictions, recieved {response.status_code} status code from SentinelOne API!"
+                )
+
+            data = response.json()
+            rows.extend(
+                (item["value"], item["osType"], item.get("createdAt"))
+                for item in data.get("data", [])
+            )
+            next_cursor = (data.get("pagination") or {}).get("nextCursor")
+            if not next_cursor:
+                break
+            params["cursor"] = next_cursor
+
+        if rebuild:
+            index.clear()
+        index.add(rows)
+        if rebuild:
+            index.mark_rebuilt()
+
+        return {"rebuilt": rebuild, "fetched": len(rows)}
+
+    def queue_blacklist(self, values, invalid=()):
+        """Queue Blacklist
+        Record values not in the local restriction index in the spool, make sure
+        a flusher is running and report.  The index is not refreshed here so
+        queueing stays local, the flusher adds what it posts to it.
+        """
+        index = RestrictionIndex(self.index_path, self.index_ttl)
+        present = index.present(values, self.s1_blacklist_ostype)
+        missing = [value for value in values if value not in present]
+
+        spool = Spool(self.spool_path)
+        queued = spool.enqueue(
+            self.s1_account_id,
+            self.s1_blacklist_type,
+            self.s1_blacklist_ostype,
+            missing,
+        )
+        start_flusher(
+            self.spool_path,
+            dict(
+                self.blacklister.config,
+                batch_size=self.spool_batch,
+                workers=self.bulk_workers,
+                index_path=self.index_path,
+                index_ttl=self.index_ttl,
+            ),
+        )
+
+        self.report(
+            {
+                "message": f"Queued {queued} hashes for the SentinelOne blacklist, "
+                f"{len(present)} already present, "
+                f"{len(missing) - queued} already queued or done.",
+                "queued": queued,
+                "already_present": len(present),
+                "invalid": list(invalid),
+                "present_hashes": sorted(present),
+                "spool": spool.stats(),
+            }
+        )
+
+    def bulk_blacklist(self):
+        """Bulk Blacklist
+        Blacklist every SHA1 in the observable (separated by whitespace, commas or
+        semicolons).  Hashes already restricted for the OS type, according to the
+        refreshed local index, are skipped and the rest are posted with up to
+        s1_bulk_workers requests in flight.  A hash whose post fails, status code
+        or connection error, is reported as failed without stopping the others.
+        """
+        hashes = dict()
+        for value in BULK_SEPARATORS.split(self.observable):
+            if value:
+                hashes.setdefault(value.lower(), value)
+
+        invalid = [h for h in hashes.values() if self.sha1_re.match(h) is None]
+        valid = [h for h in hashes if self.sha1_re.match(h) is not None]
+        if not valid:
+            self.error("No valid SHA1 hashes in observable")
+            return
+
+        if self.spool_path is not None:
+            self.queue_blacklist(valid, invalid)
+            return
+
+        index = RestrictionIndex(self.index_path, self.index_ttl)
+        refresh = self._refresh_index(index)
+        present = index.present(valid, self.s1_blacklist_ostype)
+        missing = [h for h in valid if h not in present]
+
+        def post(value):
+            try:
+                return self.blacklister.blacklist(value)
+            except requests.RequestException as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.bulk_workers) as executor:
+            responses = list(executor.map(post, missing))
+
+        new, conflicts, failed = list(), list(), dict()
+        for value, response in zip(missing, responses):
+            if isinstance(response, requests.RequestException):
+                failed[value] = str(response)
+            elif response.status_code == requests.codes.ok:
+                new.append(value)
+            elif response.status_code == requests.codes.conflict:
+                conflicts.append(value)
+            else:
+                failed[value] = response.status_code
+        present.update(conflicts)
+        index.add((value, self.s1_blacklist_ostype, None) for value in new + conflicts)
+
+        self.report(
+            {
+                "message": f"Blacklisted {len(new)} new hashes in SentinelOne, "
+                f"{len(present)} already present, {len(failed)} failed.",
+                "new": len(new),
+                "already_present": len(present),
+                "failed": len(failed),
+                "invalid": invalid,
+                "new_hashes": sorted(new),
+                "present_hashes": sorted(present),
+                "failed_hashes": failed,
+                "index": refresh,
+            }
+        )
+
     def run(self):
         Responder.run(self)
 
-        if self.service == "s1_blacklist":
+        if self.service in ("s1_blacklist", "s1_blacklist_bulk"):
             if self.s1_blacklist_ostype not in (
                 "linux",
                 "macos",
@@ -51,6 +801,14 @@ class SentinelOne(Responder):
                 self.error(f"{self.s1_blacklist_ostype} is not a valid OS Type")
                 return
 
+        if self.service == "s1_blacklist_bulk":
+            if self.observable_type not in ("hash", "other"):
+                self.error(f"{self.observable_type} observables are not supported")
+                return
+
+            self.bulk_blacklist()
+
+        elif self.service == "s1_blacklist":
             if self.observable_type != "hash":
                 self.error(f"{self.observable} is not a hash")
                 return
@@ -60,19 +818,11 @@ class SentinelOne(Responder):
                     self.error(f"{self.observable} is not a valid SHA1 hash")
                     return
 
-            response = requests.post(
-                f"{self.s1_console_url}{self.s1_blacklist_api_endpoint}",
-                headers=self.headers,
-                json={
-                    "data": {
-                        "type": self.s1_blacklist_type,
-                        "value": self.observable,
-                        "osType": self.s1_blacklist_ostype,
-                    },
-                    "filter": {"accountIds": [self.s1_account_id,]},
-                },
-                proxies=self.proxies,
-            )
+            if self.spool_path is not None:
+                self.queue_blacklist([self.observable.lower()])
+                return
+
+            response = self.blacklister.blacklist(self.observable)
 
             if response.status_code == requests.codes.ok:
                 self.report({"message": "Blacklisted in SentinelOne."})
@@ -83,8 +833,20 @@ class SentinelOne(Responder):
                 )
 
     def operations(self, raw):
+        if "queued" in raw:
+            return [self.build_operation("AddTagToArtifact", tag="SentinelOne:queued")]
+        if raw.get("failed"):
+            # only blocked once every hash is, nothing to tag if none are
+            if not raw.get("new") and not raw.get("already_present"):
+                return []
+            return [self.build_operation("AddTagToArtifact", tag="SentinelOne:partial")]
         return [self.build_operation("AddTagToArtifact", tag="SentinelOne:blocked")]
 
 
 if __name__ == "__main__":
-    SentinelOne().run()
+    if sys.argv[1:2] == ["flush"]:
+        flush(sys.argv[2])
+    elif sys.argv[1:2] == ["stats"]:
+        print(json.dumps(Spool(sys.argv[2]).stats()))
+    else:
+        SentinelOne().run()